@@ -0,0 +1,77 @@
+'''
+Benchmarking the performance and accuracy of the rotation and optimal
+densification schemes of MinHashOPHR, for sets of increasing sizes.
+'''
+import time, logging
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+from datasketch.ophr_minhash import MinHashOPHR
+
+logging.basicConfig(level=logging.INFO)
+
+def _minhash(values, k_val, densification):
+    m = MinHashOPHR(k_val, densification=densification)
+    for v in values:
+        m._update(int(v))
+    return m
+
+def run(set_size, k_val, densifications, num_rep):
+    errs = [[] for _ in densifications]
+    durs = [[] for _ in densifications]
+    for _ in range(num_rep):
+        # Two sets with a Jaccard similarity of 1/3
+        values = np.random.randint(0, 1 << 32, set_size * 3 // 2)
+        a, b = values[:set_size], values[set_size // 2:]
+        exact = float(len(set(a) & set(b))) / len(set(a) | set(b))
+        for i, densification in enumerate(densifications):
+            m1 = _minhash(a, k_val, densification)
+            m2 = _minhash(b, k_val, densification)
+            start = time.time()
+            est = m1.jaccard(m2)
+            durs[i].append((time.time() - start) * 1000)
+            errs[i].append(abs(est - exact))
+    for densification, err, dur in zip(densifications, errs, durs):
+        logging.info("%s: set size %d, mean error %.4f, average time "
+                "%.4f ms" % (densification, set_size, np.mean(err),
+                    np.mean(dur)))
+    return [np.mean(err) for err in errs], [np.mean(dur) for dur in durs]
+
+set_sizes = [10, 20, 50, 100, 200, 500, 1000]
+densifications = ['rotation', 'optimal']
+k_val = 256
+num_rep = 100
+output = "ophr_densification_benchmark.png"
+
+errs = [[] for _ in densifications]
+run_times = [[] for _ in densifications]
+for set_size in set_sizes:
+    err, dur = run(set_size, k_val, densifications, num_rep)
+    for i in range(len(densifications)):
+        errs[i].append(err[i])
+        run_times[i].append(dur[i])
+
+logging.info("> Plotting result")
+fig, axe = plt.subplots(1, 2, sharex=True, figsize=(10, 4))
+ax = axe[1]
+for densification, r in zip(densifications, run_times):
+    ax.plot(set_sizes, r, marker='+', label=densification)
+ax.set_xscale("log")
+ax.set_xlabel("Set size")
+ax.set_ylabel("Densification and Jaccard time (ms)")
+ax.set_title("MinHashOPHR performance, k = %d" % k_val)
+ax.grid()
+ax.legend()
+ax = axe[0]
+for densification, e in zip(densifications, errs):
+    ax.plot(set_sizes, e, marker='+', label=densification)
+ax.set_xscale("log")
+ax.set_xlabel("Set size")
+ax.set_ylabel("Absolute error in Jaccard estimation")
+ax.set_title("MinHashOPHR accuracy, k = %d" % k_val)
+ax.grid()
+ax.legend()
+
+fig.savefig(output, bbox_inches="tight")
+logging.info("Plot saved to %s" % output)
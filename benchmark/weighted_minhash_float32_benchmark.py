@@ -0,0 +1,88 @@
+'''
+Benchmarking the performance and accuracy of WeightedMinHash generated
+with float32 random parameters, against the default float64 parameters.
+'''
+import time, logging
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+from datasketch import WeightedMinHashGenerator
+
+logging.basicConfig(level=logging.INFO)
+
+def run_perf(wmg, data):
+    durs = []
+    for v in data:
+        start = time.time()
+        wmg.minhash(v)
+        duration = (time.time() - start) * 1000
+        durs.append(duration)
+    ave = np.mean(durs)
+    logging.info("%s: generated %d minhashes, average time %.4f ms" %
+            (wmg.dtype, len(data), ave))
+    return ave
+
+def jaccard(v1, v2):
+    min_sum = np.sum(np.minimum(v1, v2))
+    max_sum = np.sum(np.maximum(v1, v2))
+    return float(min_sum) / float(max_sum)
+
+def run_acc(wmgs, data1, data2):
+    errs = [[] for _ in wmgs]
+    diffs = []
+    for v1, v2 in zip(data1, data2):
+        j = jaccard(v1, v2)
+        estimates = [wmg.minhash(v1).jaccard(wmg.minhash(v2))
+                for wmg in wmgs]
+        for err, j_e in zip(errs, estimates):
+            err.append(abs(j - j_e))
+        diffs.append(abs(estimates[0] - estimates[1]))
+    aves = [np.mean(err) for err in errs]
+    for wmg, ave in zip(wmgs, aves):
+        logging.info("%s: %d runs, mean error %.4f" %
+                (wmg.dtype, len(data1), ave))
+    logging.info("Mean absolute difference between estimates %.4f" %
+            np.mean(diffs))
+    return aves
+
+sample_sizes = range(10, 160, 10)
+dtypes = [np.float64, np.float32]
+num_rep = 100
+dim = 5000
+output = "weighted_minhash_float32_benchmark.png"
+
+data1 = np.random.uniform(0, dim, (num_rep, dim))
+data2 = np.random.uniform(0, dim, (num_rep, dim))
+run_times = [[] for _ in dtypes]
+errs = [[] for _ in dtypes]
+for n in sample_sizes:
+    logging.info("WeightedMinHash using %d samples" % n)
+    wmgs = [WeightedMinHashGenerator(dim, sample_size=n, dtype=dtype)
+            for dtype in dtypes]
+    for i, wmg in enumerate(wmgs):
+        run_times[i].append(run_perf(wmg, data1))
+    for i, err in enumerate(run_acc(wmgs, data1, data2)):
+        errs[i].append(err)
+
+logging.info("> Plotting result")
+fig, axe = plt.subplots(1, 2, sharex=True, figsize=(10, 4))
+ax = axe[1]
+for dtype, r in zip(dtypes, run_times):
+    ax.plot(sample_sizes, r, marker='+', label=np.dtype(dtype).name)
+ax.set_xlabel("Number of samples")
+ax.set_ylabel("Running time (ms)")
+ax.set_title("WeightedMinHash performance")
+ax.grid()
+ax.legend()
+ax = axe[0]
+for dtype, e in zip(dtypes, errs):
+    ax.plot(sample_sizes, e, marker='+', label=np.dtype(dtype).name)
+ax.set_xlabel("Number of samples")
+ax.set_ylabel("Absolute error in Jaccard estimation")
+ax.set_title("WeightedMinHash accuracy")
+ax.grid()
+ax.legend()
+
+fig.savefig(output, bbox_inches="tight")
+logging.info("Plot saved to %s" % output)
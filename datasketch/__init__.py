@@ -8,9 +8,11 @@ to exact solutions to data mining and data integration problems.
 """
 from datasketch.minhash import MinHash
 from datasketch.ophr_minhash import MinHashOPHR
-from datasketch.b_bit_minhash import bBitMinHash
-from datasketch.lsh import MinHashLSH, WeightedMinHashLSH
-from datasketch.weighted_minhash import WeightedMinHash, WeightedMinHashGenerator
+from datasketch.b_bit_minhash import bBitMinHash, bBitWeightedMinHash, \
+        bBitMinHashStore
+from datasketch.lsh import MinHashLSH, WeightedMinHashLSH, bBitMinHashLSH
+from datasketch.weighted_minhash import WeightedMinHash, WeightedMinHashGenerator, \
+        IncrementalWeightedMinHash
 from datasketch.minheap_minhash import MinHashMinHeap
 from datasketch.partition_minhash import PartitionMinHash, BetterWeightedPartitionMinHash
 
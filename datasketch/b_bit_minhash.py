@@ -9,12 +9,35 @@ of each minimum hashed value, without significant loss of accuracy.
 import struct
 import numpy as np
 
+from datasketch.weighted_minhash import _splitmix64
+
+if hasattr(np, 'bitwise_count'):
+    def _popcount(words, axis=None):
+        '''
+        Count the set bits in a contiguous array of uint64 words,
+        in total or along the last `axis`.
+        '''
+        return np.bitwise_count(words).sum(axis=axis, dtype=np.int64)
+else:
+    def _popcount(words, axis=None):
+        '''
+        Count the set bits in a contiguous array of uint64 words,
+        in total or along the last `axis`.
+        '''
+        bits = np.unpackbits(words.view(np.uint8), axis=axis)
+        return np.count_nonzero(bits, axis=axis)
+
 class bBitMinHash(object):
     '''
     The b-bit MinHash object
+
+    The hash values are kept packed in memory as bit-planes: plane j is
+    an array of uint64 words holding bit j of every hash value, so a
+    sketch with 128 permutations and b = 1 takes 16 bytes. Comparisons
+    XOR the planes and count the mismatching positions with a popcount.
     '''
 
-    __slots__ = ('seed', 'b', 'r', 'hashvalues')
+    __slots__ = ('seed', 'b', 'r', '_planes', '_num_perm')
 
     # seed as int64
     # b as uint8
@@ -23,6 +46,8 @@ class bBitMinHash(object):
     _serial_fmt_params = '<qBdi'
     # each block as uint64
     _serial_fmt_block = 'Q'
+    # set in the b byte for the bit-stream format
+    _serial_tight_flag = 0x80
 
     def __init__(self, minhash, b=1, r=0.0):
         '''
@@ -37,11 +62,31 @@ class bBitMinHash(object):
         if r > 1.0:
             raise ValueError("r must be a float in [0.0, 1.0]")
         bmask = (1 << b) - 1
-        self.hashvalues = np.bitwise_and(minhash.hashvalues, bmask)\
-                .astype(np.uint32)
         self.seed = minhash.seed
         self.b = b
         self.r = r
+        self.hashvalues = np.bitwise_and(minhash.hashvalues, bmask)\
+                .astype(np.uint32)
+
+    @property
+    def hashvalues(self):
+        '''
+        The b-bit hash values as a uint32 array, unpacked from the
+        bit-planes.
+        '''
+        return self._unpack_planes(self._planes, self._num_perm)
+
+    @hashvalues.setter
+    def hashvalues(self, hashvalues):
+        hashvalues = np.asarray(hashvalues, dtype=np.uint32)
+        self._num_perm = hashvalues.size
+        self._planes = self._pack_planes(hashvalues, self._num_bits())
+
+    def __len__(self):
+        '''
+        Return the number of hash values.
+        '''
+        return self._num_perm
 
     def __eq__(self, other):
         '''
@@ -49,7 +94,8 @@ class bBitMinHash(object):
         '''
         return self.seed == other.seed and self.b == other.b and \
                 self.r == other.r and \
-                np.array_equal(self.hashvalues, other.hashvalues)
+                self._num_perm == other._num_perm and \
+                np.array_equal(self._planes, other._planes)
 
     def jaccard(self, other):
         '''
@@ -62,39 +108,67 @@ class bBitMinHash(object):
         if self.seed != other.seed:
             raise ValueError("Cannot compare two b-bit MinHashes with different\
                     set of permutations")
-        intersection = np.count_nonzero(self.hashvalues==other.hashvalues)
-        raw_est = float(intersection) / float(self.hashvalues.size)
+        raw_est = float(self._count_equal(other)) / float(self._num_perm)
         a1 = self._calc_a(self.r, self.b)
         a2 = self._calc_a(other.r, other.b)
         c1, c2 = self._calc_c(a1, a2, self.r, other.r)
         return (raw_est - c1) / (1 - c2)
 
-    def bytesize(self):
+    def bytesize(self, tight=False):
         '''
         Get the serialized size of this b-bit MinHash in number of bytes.
+        If `tight` is True, get the size in the bit-stream format used by
+        `serialize(buf, tight=True)`.
         '''
+        if tight:
+            return struct.calcsize(self._serial_fmt_params) + \
+                    (self._num_perm * self._num_bits() + 7) // 8
         return self._bytesize()[-1]
 
+    def serialize(self, buf, tight=False):
+        '''
+        Serialize this b-bit MinHash into bytes, store in `buf`.
+        By default, the hash values are stored in slots of 1, 2, 4, 8, 16
+        or 32 bits packed in uint64 blocks, the format used by pickle.
+        If `tight` is True, they are stored as a stream of exactly b bits
+        each, which is smaller when b is not a power of two; this format
+        is flagged by the highest bit of the b byte in the header.
+        '''
+        if len(buf) < self.bytesize(tight):
+            raise ValueError("The buffer does not have enough space\
+                    for holding this b-bit MinHash.")
+        b = (self.b | self._serial_tight_flag) if tight else self.b
+        struct.pack_into(self._serial_fmt_params, buf, 0, self.seed,
+                b, self.r, self._num_perm)
+        offset = struct.calcsize(self._serial_fmt_params)
+        if tight:
+            stream = self._pack_stream(self.hashvalues, self._num_bits())
+            np.frombuffer(buf, dtype=np.uint8, count=stream.size,
+                    offset=offset)[:] = stream
+            return
+        slot_size, n, num_blocks, total = self._bytesize()
+        blocks = self._pack_blocks(self.hashvalues, slot_size, n, num_blocks)
+        np.frombuffer(buf, dtype='<u8', count=num_blocks,
+                offset=offset)[:] = blocks
+
+    @classmethod
+    def deserialize(cls, buf):
+        '''
+        Reconstruct a b-bit MinHash from a byte buffer created by
+        `serialize`, in either format.
+        '''
+        bm = cls.__new__(cls)
+        bm.__setstate__(buf)
+        return bm
+
     def __getstate__(self):
         '''
         This function is called when pickling the b-bit MinHash object.
         Returns a bytearray which will then be pickled.
         '''
-        slot_size, n, num_blocks, total = self._bytesize()
-        buffer = bytearray(total)
-        blocks = np.zeros((num_blocks,), dtype=np.uint64)
-        for i in range(num_blocks):
-            # Obtain the current segment of n hashed values
-            start = i * n
-            hvs = self.hashvalues[start:start+n]
-            # Store the n b-bit hashed values in the current block
-            for j, hv in enumerate(hvs):
-                blocks[i] |= np.uint64(hv << (n - 1 - j) * slot_size)
-        fmt = self._serial_fmt_params + \
-                "%d%s" % (num_blocks, self._serial_fmt_block)
-        struct.pack_into(fmt, buffer, 0, self.seed, self.b, self.r, \
-                self.hashvalues.size, *blocks)
-        return buffer
+        buf = bytearray(self.bytesize())
+        self.serialize(buf)
+        return buf
 
     def __setstate__(self, buf):
         '''
@@ -102,28 +176,152 @@ class bBitMinHash(object):
         Initialize the object with data in the buffer.
         '''
         try:
-            self.seed, self.b, self.r, num_perm = \
+            self.seed, b, self.r, num_perm = \
                     struct.unpack_from(self._serial_fmt_params, buf, 0)
         except TypeError:
-            self.seed, self.b, self.r, num_perm = \
+            self.seed, b, self.r, num_perm = \
                     struct.unpack_from(self._serial_fmt_params, buffer(buf), 0)
         offset = struct.calcsize(self._serial_fmt_params)
-        self.hashvalues = np.zeros((num_perm,), dtype=np.uint32)
+        self.b = b & ~self._serial_tight_flag
+        self._num_perm = num_perm
         # Reconstruct the hash values
+        if b & self._serial_tight_flag:
+            num_bits = self._num_bits()
+            stream = np.frombuffer(buf, dtype=np.uint8,
+                    count=(num_perm * num_bits + 7) // 8, offset=offset)
+            self.hashvalues = self._unpack_stream(stream, num_bits, num_perm)
+            return
         slot_size, n, num_blocks, total = self._bytesize()
-        fmt = "%d%s" % (num_blocks, self._serial_fmt_block)
-        try:
-            blocks = struct.unpack_from(fmt, buf, offset)
-        except TypeError:
-            blocks = struct.unpack_from(fmt, buffer(buf), offset)
-        mask = (1 << slot_size) - 1
-        for i in range(num_blocks):
-            start = i * n
-            for j, _ in enumerate(self.hashvalues[start:start+n]):
-                hv = (blocks[i] >> (n - 1 - j) * slot_size) & mask
-                self.hashvalues[start+j] = np.uint32(hv)
+        blocks = np.frombuffer(buf, dtype='<u8', count=num_blocks,
+                offset=offset)
+        self.hashvalues = self._unpack_blocks(blocks, slot_size, n,
+                num_perm)
 
-    def _calc_a(self, r, b):
+    def _count_equal(self, other):
+        '''
+        Count the positions at which the hash values of this b-bit
+        MinHash and the other are equal.
+        '''
+        if self._num_perm != other._num_perm:
+            raise ValueError("Cannot compare two b-bit MinHashes with different\
+                    numbers of permutation functions")
+        # A position differs if any of its bits differs; the padding
+        # bits are zero in both and never count as a mismatch.
+        diff = self._planes ^ other._planes
+        if len(diff) == 1:
+            diff = diff[0]
+        else:
+            diff = np.bitwise_or.reduce(diff, axis=0)
+        return self._num_perm - int(_popcount(diff))
+
+    def _num_bits(self):
+        '''
+        Number of bits stored for each hash value, i.e. the number of
+        bit-planes.
+        '''
+        return self.b
+
+    def _corrections(self, rs):
+        '''
+        Compute the constants C1 and C2 correcting the raw match ratio
+        between this b-bit MinHash and others with the given r values.
+        Returns two arrays aligned with `rs`.
+        This computes `_calc_a` and `_calc_c` for all r values at once.
+        '''
+        rs = np.asarray(rs, dtype=np.float64)
+        a1 = self._calc_a(self.r, self.b)
+        zero = rs == 0.0
+        # The limits are used for r = 0, the substituted r avoids
+        # dividing by zero in the unused branch
+        safe = np.where(zero, 0.5, rs)
+        a2 = np.where(zero, 1.0 / (1 << self.b),
+                safe * (1 - safe) ** (2 ** self.b - 1) /
+                (1 - (1 - safe) ** (2 * self.b)))
+        both = zero & (self.r == 0.0)
+        div = 1 / np.where(both, 1.0, self.r + rs)
+        c1 = np.where(both, a1, (a1 * rs + a2 * self.r) * div)
+        c2 = np.where(both, a2, (a1 * self.r + a2 * rs) * div)
+        return c1, c2
+
+    @staticmethod
+    def _pack_planes(hashvalues, num_bits):
+        '''
+        Pack the hash values into a (num_bits, num_words) uint64 array,
+        where bit i of word w in plane j is bit j of hash value 64*w+i.
+        '''
+        num_words = (hashvalues.size + 63) // 64
+        hvs = np.zeros((num_words * 64,), dtype=np.uint64)
+        hvs[:hashvalues.size] = hashvalues
+        shifts = np.arange(num_bits, dtype=np.uint64)[:, np.newaxis]
+        bits = (hvs >> shifts) & np.uint64(1)
+        offsets = np.arange(64, dtype=np.uint64)
+        return np.bitwise_or.reduce(
+                bits.reshape(num_bits, num_words, 64) << offsets, axis=2)
+
+    @staticmethod
+    def _unpack_planes(planes, num_perm):
+        '''
+        Unpack `num_perm` hash values from the bit-planes created by
+        `_pack_planes`.
+        '''
+        num_bits = planes.shape[0]
+        if num_bits == 0:
+            # 0-bit hash values are all zero
+            return np.zeros(num_perm, dtype=np.uint32)
+        offsets = np.arange(64, dtype=np.uint64)
+        bits = (planes[:, :, np.newaxis] >> offsets) & np.uint64(1)
+        bits = bits.reshape(num_bits, -1)[:, :num_perm]
+        shifts = np.arange(num_bits, dtype=np.uint64)[:, np.newaxis]
+        return np.bitwise_or.reduce(bits << shifts, axis=0)\
+                .astype(np.uint32).reshape(num_perm)
+
+    @staticmethod
+    def _pack_stream(hashvalues, num_bits):
+        '''
+        Pack the hash values into a stream of bytes holding exactly
+        `num_bits` bits per value, most significant bits first.
+        '''
+        shifts = np.arange(num_bits - 1, -1, -1, dtype=np.uint32)
+        bits = (hashvalues[:, np.newaxis] >> shifts) & 1
+        return np.packbits(bits.astype(np.uint8).ravel())
+
+    @staticmethod
+    def _unpack_stream(stream, num_bits, num_perm):
+        '''
+        Unpack `num_perm` hash values from the stream of bytes created
+        by `_pack_stream`.
+        '''
+        bits = np.unpackbits(stream)[:num_perm * num_bits]\
+                .reshape(num_perm, num_bits).astype(np.uint32)
+        shifts = np.arange(num_bits - 1, -1, -1, dtype=np.uint32)
+        return np.bitwise_or.reduce(bits << shifts, axis=1)\
+                .astype(np.uint32).reshape(num_perm)
+
+    @staticmethod
+    def _pack_blocks(hashvalues, slot_size, n, num_blocks):
+        '''
+        Pack the hash values into `num_blocks` uint64 blocks of `n` slots
+        each, the first hash value of a block in its highest slot.
+        '''
+        slots = np.zeros((num_blocks * n,), dtype=np.uint64)
+        slots[:hashvalues.size] = hashvalues
+        shifts = ((n - 1 - np.arange(n)) * slot_size).astype(np.uint64)
+        return np.bitwise_or.reduce(slots.reshape(num_blocks, n) << shifts,
+                axis=1)
+
+    @staticmethod
+    def _unpack_blocks(blocks, slot_size, n, num_perm):
+        '''
+        Unpack `num_perm` hash values from the blocks created by
+        `_pack_blocks`.
+        '''
+        shifts = ((n - 1 - np.arange(n)) * slot_size).astype(np.uint64)
+        mask = np.uint64((1 << slot_size) - 1)
+        slots = (blocks.astype(np.uint64)[:, np.newaxis] >> shifts) & mask
+        return slots.ravel()[:num_perm].astype(np.uint32)
+
+    @staticmethod
+    def _calc_a(r, b):
         '''
         Compute the function A(r, b)
         '''
@@ -132,7 +330,8 @@ class bBitMinHash(object):
             return 1.0 / (1 << b)
         return r * (1 - r) ** (2 ** b - 1) / (1 - (1 - r) ** (2 * b))
 
-    def _calc_c(self, a1, a2, r1, r2):
+    @staticmethod
+    def _calc_c(a1, a2, r1, r2):
         '''
         Compute the functions C1 and C2
         '''
@@ -169,9 +368,207 @@ class bBitMinHash(object):
         # Get the number of slots to be stored in each block
         num_slots_per_block = int(block_size * 8 / slot_size)
         # Get the number of blocks required
-        num_blocks = int(np.ceil(float(self.hashvalues.size) /\
+        num_blocks = int(np.ceil(float(self._num_perm) /\
                 num_slots_per_block))
         # Get the total serialized size
         total = struct.calcsize(self._serial_fmt_params + \
                 "%d%s" % (num_blocks, self._serial_fmt_block))
         return slot_size, num_slots_per_block, num_blocks, total
+
+
+class bBitWeightedMinHash(bBitMinHash):
+    '''
+    The b-bit Weighted MinHash object, compressing each (k, t) hash value
+    of a Weighted MinHash to the b lowest bits of a hash of the pair.
+    With b = 0, it is the 0-bit Consistent Weighted Sampling, keeping the
+    index k only.
+    https://www.stat.rutgers.edu/home/pingli/papers/0-bit-CWS-KDD.pdf
+    '''
+
+    __slots__ = ()
+
+    def __init__(self, weighted_minhash, b=1, r=0.0):
+        '''
+        Initialize a b-bit Weighted MinHash given an existing
+        WeightedMinHash object and parameter b - the number of bits to
+        store for each hash value, or 0 to store the full index k only.
+        `r` has the same meaning as for `bBitMinHash`; it is close to 0
+        for sparse weighted vectors.
+        '''
+        b = int(b)
+        r = float(r)
+        if b > 32 or b < 0:
+            raise ValueError("b must be an integer in [0, 32]")
+        if r > 1.0:
+            raise ValueError("r must be a float in [0.0, 1.0]")
+        self.seed = weighted_minhash.seed
+        self.b = b
+        self.r = r
+        hashvalues = np.asarray(weighted_minhash.hashvalues)
+        ks = hashvalues[:, 0].astype(np.uint64)
+        if b == 0:
+            self.hashvalues = ks.astype(np.uint32)
+        else:
+            ts = hashvalues[:, 1].astype(np.int64).astype(np.uint64)
+            hvs = _splitmix64(_splitmix64(ks) ^ ts)
+            bmask = np.uint64((1 << b) - 1)
+            self.hashvalues = np.bitwise_and(hvs, bmask).astype(np.uint32)
+
+    def jaccard(self, other):
+        '''
+        Estimate the weighted Jaccard similarity between this b-bit
+        Weighted MinHash and the other.
+        With b = 0, the estimate is the fraction of equal indexes k,
+        which approximates the weighted Jaccard similarity closely.
+        '''
+        if self.b != 0:
+            return super(bBitWeightedMinHash, self).jaccard(other)
+        if self.b != other.b:
+            raise ValueError("Cannot compare two b-bit MinHashes with different\
+                    b values")
+        if self.seed != other.seed:
+            raise ValueError("Cannot compare two b-bit MinHashes with different\
+                    set of permutations")
+        return float(self._count_equal(other)) / float(self._num_perm)
+
+    def _num_bits(self):
+        if self.b == 0:
+            # The full 32-bit index k is stored
+            return 32
+        return self.b
+
+    def _corrections(self, rs):
+        if self.b != 0:
+            return super(bBitWeightedMinHash, self)._corrections(rs)
+        return np.zeros(len(rs)), np.zeros(len(rs))
+
+    def _find_slot_size(self, b):
+        if b == 0:
+            # The full 32-bit index k is stored
+            return 32
+        return super(bBitWeightedMinHash, self)._find_slot_size(b)
+
+
+class bBitMinHashStore(object):
+    '''
+    A columnar store of b-bit MinHashes sharing the same b, seed and
+    number of permutation functions, for brute-force similarity scans.
+    The bit-planes of all sketches are kept in a single uint64 matrix,
+    and `scan` compares a query against blocks of rows at once.
+
+    Args:
+        num_perm (int): The number of permutation functions of the
+            sketches.
+        b (int): The number of bits stored per hash value.
+        seed (int): The seed of the sketches.
+        block_size (int): The number of rows compared at once by `scan`.
+    '''
+
+    def __init__(self, num_perm=128, b=1, seed=1, block_size=4096):
+        if block_size < 1:
+            raise ValueError("block_size must be positive")
+        self.num_perm = num_perm
+        self.b = b
+        self.seed = seed
+        self.block_size = block_size
+        self._planes = None
+        self._pending = []
+        self._shape = None
+        # Distinct r values, their indexes, and the index of each row's
+        # r value
+        self._rs = []
+        self._r_ids = dict()
+        self._r_index = []
+
+    def __len__(self):
+        '''
+        Return the number of b-bit MinHashes in the store.
+        '''
+        return len(self._r_index)
+
+    def add(self, bminhash):
+        '''
+        Append a b-bit MinHash to the store. Its index is the number of
+        sketches added before it.
+        '''
+        self._check(bminhash)
+        if self._shape is None:
+            self._shape = bminhash._planes.shape
+        self._pending.append(bminhash._planes)
+        if bminhash.r not in self._r_ids:
+            self._r_ids[bminhash.r] = len(self._rs)
+            self._rs.append(bminhash.r)
+        self._r_index.append(self._r_ids[bminhash.r])
+
+    def add_many(self, bminhashes):
+        '''
+        Append the b-bit MinHashes in the iterable `bminhashes`.
+        '''
+        for bminhash in bminhashes:
+            self.add(bminhash)
+
+    def scan(self, query, threshold=None):
+        '''
+        Estimate the Jaccard similarity between the b-bit MinHash `query`
+        and every sketch in the store.
+
+        Args:
+            query (datasketch.bBitMinHash): The query sketch.
+            threshold (float, optional): The minimum estimate to return.
+                By default, the estimates of all sketches are returned.
+
+        Returns:
+            (indices, estimates): Two arrays holding the indexes of the
+            sketches whose estimate is at least `threshold`, in
+            increasing order, and their estimates.
+        '''
+        self._check(query)
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0)
+        planes = self._matrix()
+        # The correction constants only depend on the r value of a row
+        c1, c2 = query._corrections(self._rs)
+        r_index = np.array(self._r_index, dtype=np.intp)
+        indices, estimates = [], []
+        for start in range(0, len(planes), self.block_size):
+            block = planes[start:start+self.block_size] ^ query._planes
+            diff = np.bitwise_or.reduce(block, axis=1)
+            mismatches = _popcount(diff, axis=-1)
+            raw = (self.num_perm - mismatches) / float(self.num_perm)
+            ri = r_index[start:start+self.block_size]
+            est = (raw - c1[ri]) / (1 - c2[ri])
+            if threshold is None:
+                found = np.arange(len(est))
+            else:
+                found = np.nonzero(est >= threshold)[0]
+            indices.append(found + start)
+            estimates.append(est[found])
+        return np.concatenate(indices), np.concatenate(estimates)
+
+    def _check(self, bminhash):
+        if bminhash.b != self.b:
+            raise ValueError("Cannot compare two b-bit MinHashes with different\
+                    b values")
+        if bminhash.seed != self.seed:
+            raise ValueError("Cannot compare two b-bit MinHashes with different\
+                    set of permutations")
+        if len(bminhash) != self.num_perm:
+            raise ValueError("Cannot compare two b-bit MinHashes with different\
+                    numbers of permutation functions")
+        if self._shape is not None and bminhash._planes.shape != self._shape:
+            raise ValueError("Cannot compare two b-bit MinHashes with different\
+                    numbers of bits per hash value")
+
+    def _matrix(self):
+        '''
+        Return the (n, num_bits, num_words) matrix of bit-planes of a
+        non-empty store, appending the pending sketches first.
+        '''
+        if self._pending:
+            pending = np.stack(self._pending)
+            if self._planes is None:
+                self._planes = pending
+            else:
+                self._planes = np.concatenate([self._planes, pending])
+            self._pending = []
+        return self._planes
@@ -6,6 +6,10 @@ Both indexes supports query with Jaccard similarity threshold.
 Reference: Chapter 3, Mining of Massive Datasets 
 (http://www.mmds.org/)
 '''
+import sys, time, heapq, bisect, itertools, collections
+import numpy as np
+
+from datasketch.b_bit_minhash import bBitMinHash
 
 
 _integration_precision = 0.001
@@ -25,31 +29,38 @@ except ImportError:
     integrate = _integration
 
 
-def _false_positive_probability(threshold, b, r):
-    _probability = lambda s : 1 - (1 - s**float(r))**float(b)
+def _false_positive_probability(threshold, b, r, collision=None):
+    if collision is None:
+        collision = lambda s : s
+    _probability = lambda s : 1 - (1 - collision(s)**float(r))**float(b)
     a, err = integrate(_probability, 0.0, threshold) 
     return a
 
 
-def _false_negative_probability(threshold, b, r):
-    _probability = lambda s : 1 - (1 - (1 - s**float(r))**float(b))
+def _false_negative_probability(threshold, b, r, collision=None):
+    if collision is None:
+        collision = lambda s : s
+    _probability = lambda s : 1 - (1 - (1 - collision(s)**float(r))**float(b))
     a, err = integrate(_probability, threshold, 1.0)
     return a
 
 
 def _optimal_param(threshold, num_perm, false_positive_weight,
-        false_negative_weight):
+        false_negative_weight, collision=None):
     '''
     Compute the optimal `MinHashLSH` parameter that minimizes the weighted sum
     of probabilities of false positive and false negative.
+    `collision` optionally maps the Jaccard similarity to the probability
+    that a single hash value collides, which is the similarity itself
+    for MinHash.
     '''
     min_error = float("inf")
     opt = (0, 0)
     for b in range(1, num_perm+1):
         max_r = int(num_perm / b)
         for r in range(1, max_r+1):
-            fp = _false_positive_probability(threshold, b, r)
-            fn = _false_negative_probability(threshold, b, r)
+            fp = _false_positive_probability(threshold, b, r, collision)
+            fn = _false_negative_probability(threshold, b, r, collision)
             error = fp*false_positive_weight + fn*false_negative_weight
             if error < min_error:
                 min_error = error
@@ -57,12 +68,54 @@ def _optimal_param(threshold, num_perm, false_positive_weight,
     return opt
 
 
+class _UnionFind(object):
+    '''
+    Disjoint sets over hashable items, with path compression
+    and union by size.
+    '''
+
+    def __init__(self):
+        self.parents = dict()
+        self.sizes = dict()
+
+    def find(self, x):
+        if x not in self.parents:
+            self.parents[x] = x
+            self.sizes[x] = 1
+            return x
+        root = x
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[x] != root:
+            self.parents[x], x = root, self.parents[x]
+        return root
+
+    def union(self, x, y):
+        x, y = self.find(x), self.find(y)
+        if x == y:
+            return
+        if self.sizes[x] < self.sizes[y]:
+            x, y = y, x
+        self.parents[y] = x
+        self.sizes[x] += self.sizes.pop(y)
+
+    def groups(self):
+        groups = dict()
+        for x in self.parents:
+            root = self.find(x)
+            if root not in groups:
+                groups[root] = set()
+            groups[root].add(x)
+        return list(groups.values())
+
+
 class MinHashLSH(object):
     '''
     The classic MinHash LSH
     '''
 
-    def __init__(self, threshold=0.9, num_perm=128, weights=(0.5,0.5)):
+    def __init__(self, threshold=0.9, num_perm=128, weights=(0.5,0.5),
+            query_hook=None, max_bucket_size=None, params=None):
         '''
         Create an empty `MinHashLSH` index that accepts MinHash objects
         with `num_perm` permutation functions and query
@@ -75,6 +128,24 @@ class MinHashLSH(object):
         for the Jaccard similarity threshold.
         `weights` is a tuple in the format of 
         (false_positive_weight, false_negative_weight).
+
+        `query_hook` is an optional callable invoked after every `query`
+        with a dict of per-query counters: `bands_probed`, `buckets_hit`,
+        `candidates_touched` (total length of the buckets scanned),
+        `num_candidates` and `time` (seconds spent in the query).
+        Note that an index holding a lambda as hook cannot be pickled.
+
+        `max_bucket_size` caps the number of keys stored in a single
+        bucket. Keys inserted into a full bucket are tracked as overflow
+        of that bucket instead, and will not be found through it by
+        `query` until a stored key is removed from the bucket. This bounds the cost of queries hitting buckets created
+        by boilerplate content. By default the bucket size is unbounded.
+
+        `params` can be used to bypass the optimization and set the
+        number of bands and rows per band directly, as a tuple (b, r).
+        This is typically used together with multi-probe queries
+        (see `query`), to build an index with long bands whose effective
+        length can be shortened per query.
         '''
         if threshold > 1.0 or threshold < 0.0:
             raise ValueError("threshold must be in [0.0, 1.0]") 
@@ -84,21 +155,92 @@ class MinHashLSH(object):
             raise ValueError("Weight must be in [0.0, 1.0]")
         if sum(weights) != 1.0:
             raise ValueError("Weights must sum to 1.0")
+        if max_bucket_size is not None and max_bucket_size < 1:
+            raise ValueError("max_bucket_size must be at least 1")
         self.threshold = threshold
         self.h = num_perm
-        false_positive_weight, false_negative_weight = weights
-        self.b, self.r = _optimal_param(threshold, num_perm,
-                false_positive_weight, false_negative_weight)
+        if params is not None:
+            self.b, self.r = params
+            if self.b * self.r > num_perm:
+                raise ValueError("The product of b and r must not exceed "
+                        "num_perm")
+        else:
+            false_positive_weight, false_negative_weight = weights
+            self.b, self.r = _optimal_param(threshold, num_perm,
+                    false_positive_weight, false_negative_weight,
+                    self._collision_probability)
         self.hashtables = [dict() for _ in range(self.b)]
         self.hashranges = [(i*self.r, (i+1)*self.r) for i in range(self.b)]
         self.keys = dict()
+        self.query_hook = query_hook
+        self.max_bucket_size = max_bucket_size
+        self.overflow = [dict() for _ in range(self.b)]
+        # Sorted bucket hashes of each band for multi-probe queries,
+        # built by the first of them. The buckets created and removed
+        # since are buffered, and merged by the next multi-probe query.
+        self.sorted_hashes = [None for _ in range(self.b)]
+        self._added_hashes = [set() for _ in range(self.b)]
+        self._removed_hashes = [set() for _ in range(self.b)]
 
     def is_empty(self):
         return any(len(t) == 0 for t in self.hashtables)
 
+    def _collision_probability(self, s):
+        '''
+        The probability that a single hash value of two MinHash
+        collides given their Jaccard similarity `s`.
+        '''
+        return s
+
+    def _similarity(self, p):
+        '''
+        Estimate the Jaccard similarity given the fraction `p` of equal
+        hash values, the inverse of `_collision_probability`.
+        '''
+        return p
+
+    def _hashvalues(self, minhash):
+        '''
+        Get the hash values of a MinHash object, checking its length.
+        '''
+        if len(minhash) != self.h:
+            raise ValueError("Expecting minhash with length %d, got %d"
+                    % (self.h, len(minhash)))
+        return minhash.hashvalues
+
     def _H(self, hs):
         return "".join("%.8x" % h for h in hs)
 
+    def _band_keys(self, hashvalues):
+        '''
+        Compute the bucket hashes of all bands given the hash values.
+        '''
+        return [self._H(hashvalues[start:end])
+                for start, end in self.hashranges]
+
+    def _fixed_width_band_keys(self, hashvalues):
+        '''
+        Compute the bucket hashes of all bands by hashing all hash values
+        once and slicing the result, for `_H` that encodes every hash
+        value in the same number of bytes.
+        '''
+        buf = self._H(hashvalues)
+        row_size = len(buf) // self.h
+        return [buf[start*row_size:end*row_size]
+                for start, end in self.hashranges]
+
+    def _stacked_hashvalues(self, minhashes):
+        '''
+        Get the hash values of many MinHash objects, given as a list of
+        objects or an array of stacked hash values.
+        '''
+        if isinstance(minhashes, np.ndarray):
+            if minhashes.ndim < 2 or minhashes.shape[1] != self.h:
+                raise ValueError("Expecting stacked hash values with "
+                        "length %d" % self.h)
+            return minhashes
+        return [self._hashvalues(minhash) for minhash in minhashes]
+
     def __contains__(self, key):
         '''
         Return True only if the key exists in the index.
@@ -110,34 +252,173 @@ class MinHashLSH(object):
         Insert a unique `key` to the index, together
         with a `minhash` of the data referenced by the `key`.
         '''
-        if len(minhash) != self.h:
-            raise ValueError("Expecting minhash with length %d, got %d"
-                    % (self.h, len(minhash)))
+        hashvalues = self._hashvalues(minhash)
         if key in self.keys:
             raise ValueError("The given key already exists")
-        self.keys[key] = [self._H(minhash.hashvalues[start:end]) 
-                for start, end in self.hashranges]
-        for H, hashtable in zip(self.keys[key], self.hashtables):
+        self._insert(key, self._band_keys(hashvalues))
+
+    def insert_batch(self, keys, minhashes):
+        '''
+        Insert many unique `keys` to the index, together with the
+        `minhashes` of the data referenced by the keys: either a list of
+        MinHash objects, or an array with the stacked hash values of one
+        MinHash per row, such as the output of
+        `WeightedMinHashGenerator.minhash_many` for `WeightedMinHashLSH`.
+        Nothing is inserted if any of the keys already exists.
+        '''
+        hashvalues = self._stacked_hashvalues(minhashes)
+        if len(keys) != len(hashvalues):
+            raise ValueError("Expecting as many keys as minhashes")
+        if len(set(keys)) != len(keys) or any(key in self.keys
+                for key in keys):
+            raise ValueError("The given keys are not unique")
+        for key, hvs in zip(keys, hashvalues):
+            self._insert(key, self._band_keys(hvs))
+
+    def _insert(self, key, Hs):
+        self.keys[key] = Hs
+        for i, (H, hashtable, overflow) in enumerate(zip(self.keys[key],
+                self.hashtables, self.overflow)):
             if H not in hashtable:
                 hashtable[H] = []
-            hashtable[H].append(key)
+                if self.sorted_hashes[i] is not None:
+                    if H in self._removed_hashes[i]:
+                        self._removed_hashes[i].remove(H)
+                    else:
+                        self._added_hashes[i].add(H)
+            if self.max_bucket_size is not None and \
+                    len(hashtable[H]) >= self.max_bucket_size:
+                if H not in overflow:
+                    overflow[H] = set()
+                overflow[H].add(key)
+            else:
+                hashtable[H].append(key)
 
-    def query(self, minhash):
+    def query(self, minhash, budget=None, min_votes=1, sort_by_votes=False,
+            probe_depth=0):
         '''
         Giving the MinHash of the query dataset, retrieve 
         the keys that references datasets with Jaccard
         similarities greater than the threshold set by the index.
+
+        `budget` optionally limits the number of keys returned.
+        The matching buckets are then scanned from the smallest to the
+        largest, and scanning stops as soon as `budget` distinct
+        candidates were collected, so the entries of hot buckets beyond
+        the budget are never touched. The votes of these candidates are
+        then counted in all bands, and the keys returned are ranked by
+        the number of bands in which they matched the query. Note that
+        with `min_votes` above 1, keys with enough votes but not among
+        the first `budget` candidates are not returned.
+
+        `min_votes` is the minimum number of bands in which a key must
+        collide with the query to be returned. Raising it above 1 is a cheap
+        way to filter out false positives before computing the exact
+        Jaccard similarities.
+        If `sort_by_votes` is True, the keys returned are sorted by the
+        number of bands in which they collided, in decreasing order.
+
+        `probe_depth` enables multi-probe querying: in every band, the
+        query also probes the buckets whose hash values agree with its own
+        on all but the last `probe_depth` rows of the band.
+        A band then collides with probability s^(r - probe_depth)
+        instead of s^r for Jaccard similarity s: the recall and precision
+        are exactly those of an index built with
+        `params=(b, r - probe_depth)`, which uses the same memory, but
+        the probe depth can be chosen per query.
         '''
-        if len(minhash) != self.h:
-            raise ValueError("Expecting minhash with length %d, got %d"
-                    % (self.h, len(minhash)))
-        candidates = set()
-        for (start, end), hashtable in zip(self.hashranges, self.hashtables):
-            H = self._H(minhash.hashvalues[start:end])
-            if H in hashtable:
-                for key in hashtable[H]:
-                    candidates.add(key)
-        return list(candidates)
+        return self._query(self._hashvalues(minhash), budget, min_votes,
+                sort_by_votes, probe_depth)
+
+    def query_batch(self, minhashes, **kwargs):
+        '''
+        Query the index with many MinHash at once, given as a list
+        of MinHash objects or an array of stacked hash values (see
+        `insert_batch`). The keyword arguments are the same as `query`.
+        Returns a list with the result of each query.
+        '''
+        return [self._query(hvs, **kwargs)
+                for hvs in self._stacked_hashvalues(minhashes)]
+
+    def _query(self, hashvalues, budget=None, min_votes=1,
+            sort_by_votes=False, probe_depth=0):
+        if budget is not None and budget < 1:
+            raise ValueError("budget must be at least 1")
+        if min_votes < 1 or min_votes > self.b:
+            raise ValueError("min_votes must be in [1, %d]" % self.b)
+        if probe_depth < 0 or probe_depth >= self.r:
+            raise ValueError("probe_depth must be in [0, %d]" % (self.r - 1))
+        if self.query_hook is not None:
+            start_time = time.time()
+        # The (band index, bucket hash) of the buckets hit
+        probed = []
+        if probe_depth == 0:
+            for i, (H, hashtable) in enumerate(zip(
+                    self._band_keys(hashvalues), self.hashtables)):
+                if H in hashtable:
+                    probed.append((i, H))
+        else:
+            for i, (start, end) in enumerate(self.hashranges):
+                prefix = self._H(hashvalues[start:end-probe_depth])
+                probed.extend((i, H) for H in self._prefix_match(i, prefix))
+        buckets = [self.hashtables[i][H] for i, H in probed]
+        touched = 0
+        if budget is None and min_votes == 1 and not sort_by_votes:
+            candidates = set()
+            for bucket in buckets:
+                touched += len(bucket)
+                candidates.update(bucket)
+            result = list(candidates)
+        else:
+            votes = collections.Counter()
+            if budget is None:
+                for bucket in buckets:
+                    touched += len(bucket)
+                    votes.update(bucket)
+            else:
+                admitted = set()
+                for bucket in sorted(buckets, key=len):
+                    if len(admitted) >= budget:
+                        break
+                    # Keys already seen do not use up the budget
+                    for key in bucket:
+                        touched += 1
+                        admitted.add(key)
+                        if len(admitted) >= budget:
+                            break
+                # The buckets left unscanned may hold more votes of the
+                # keys admitted, so count them in all bands hit
+                votes = self._count_votes(admitted, probed)
+            if budget is None and not sort_by_votes:
+                result = [key for key, count in votes.items()
+                        if count >= min_votes]
+            else:
+                result = [key for key, count in votes.most_common()
+                        if count >= min_votes][:budget]
+        if self.query_hook is not None:
+            self.query_hook({
+                "bands_probed" : self.b,
+                "buckets_hit" : len(buckets),
+                "candidates_touched" : touched,
+                "num_candidates" : len(result),
+                "time" : time.time() - start_time,
+            })
+        return result
+
+    def _count_votes(self, keys, probed):
+        '''
+        Count the number of bands in which each of the keys is stored in
+        one of the buckets given as (band index, bucket hash) pairs.
+        '''
+        hashes = [set() for _ in range(self.b)]
+        for i, H in probed:
+            hashes[i].add(H)
+        votes = collections.Counter()
+        for key in keys:
+            for i, H in enumerate(self.keys[key]):
+                if H in hashes[i] and key not in self.overflow[i].get(H, ()):
+                    votes[key] += 1
+        return votes
 
     def remove(self, key):
         '''
@@ -145,19 +426,235 @@ class MinHashLSH(object):
         '''
         if key not in self.keys:
             raise ValueError("The given key does not exist")
-        for H, hashtable in zip(self.keys[key], self.hashtables):
+        for i, (H, hashtable, overflow) in enumerate(zip(self.keys[key],
+                self.hashtables, self.overflow)):
+            if H in overflow and key in overflow[H]:
+                overflow[H].remove(key)
+                if len(overflow[H]) == 0:
+                    overflow.pop(H)
+                continue
             hashtable[H].remove(key)
+            if H in overflow:
+                # Move an overflow key into the freed slot, so the
+                # overflow keys stay reachable
+                hashtable[H].append(overflow[H].pop())
+                if len(overflow[H]) == 0:
+                    overflow.pop(H)
             if len(hashtable[H]) == 0:
                 hashtable.pop(H)
+                if self.sorted_hashes[i] is not None:
+                    if H in self._added_hashes[i]:
+                        self._added_hashes[i].remove(H)
+                    else:
+                        self._removed_hashes[i].add(H)
         self.keys.pop(key)
 
+    def self_join(self, minhashes=None, threshold=None):
+        '''
+        Find all pairs of keys in the index that collide in at least one
+        band. This walks the buckets of each band once, and a pair is
+        only emitted from the first band in which it collides, so
+        every pair is produced exactly once.
+        Keys tracked as overflow of a full bucket (see `max_bucket_size`)
+        are joined with that bucket too, so no pair is missed, but the
+        cost of a bucket is quadratic in its size including overflow.
+        The pairs are streamed as (key1, key2) tuples by this generator.
+
+        If `minhashes`, a dict-like mapping every key in the index to its
+        MinHash, is given, the candidate pairs are verified: the Jaccard
+        similarities are estimated for all pairs of a bucket at once,
+        and only the pairs with similarity at least `threshold`
+        (by default the threshold of the index) are emitted, as
+        (key1, key2, jaccard) tuples.
+        '''
+        if minhashes is not None and threshold is None:
+            threshold = self.threshold
+        for i, (hashtable, overflow) in enumerate(zip(self.hashtables,
+                self.overflow)):
+            # Overflow keys are normally moved into their bucket when a
+            # stored key is removed, but cover overflow without a bucket
+            buckets = itertools.chain(hashtable.items(),
+                    ((H, []) for H in overflow if H not in hashtable))
+            for H, bucket in buckets:
+                if H in overflow:
+                    bucket = bucket + list(overflow[H])
+                if len(bucket) < 2:
+                    continue
+                if minhashes is not None:
+                    hvs = np.array([minhashes[key].hashvalues
+                        for key in bucket])
+                for a in range(len(bucket)-1):
+                    key1 = bucket[a]
+                    if minhashes is not None:
+                        eq = hvs[a+1:] == hvs[a]
+                        if eq.ndim > 2:
+                            # Weighted MinHash hash values are (k, t) pairs
+                            eq = eq.all(axis=tuple(range(2, eq.ndim)))
+                        sims = self._similarity(
+                                np.count_nonzero(eq, axis=1) / float(self.h))
+                    for c, key2 in enumerate(bucket[a+1:]):
+                        if minhashes is not None and sims[c] < threshold:
+                            continue
+                        if self._collided_before(i, key1, key2):
+                            continue
+                        if minhashes is not None:
+                            yield key1, key2, sims[c]
+                        else:
+                            yield key1, key2
+
+    def self_join_clusters(self, minhashes=None, threshold=None):
+        '''
+        Group the keys in the index into clusters of near-duplicates:
+        the connected components of the pairs found by `self_join`,
+        which takes the same arguments.
+        Returns a list of sets of keys; keys without any near-duplicate
+        are not included.
+        '''
+        uf = _UnionFind()
+        for pair in self.self_join(minhashes, threshold):
+            uf.union(pair[0], pair[1])
+        return uf.groups()
+
+    def _collided_before(self, i, key1, key2):
+        '''
+        Check if the two keys share a bucket in any band before the i-th.
+        '''
+        Hs1, Hs2 = self.keys[key1], self.keys[key2]
+        return any(Hs1[j] == Hs2[j] for j in range(i))
+
+    def _prefix_match(self, i, prefix):
+        '''
+        Find the bucket hashes in the i-th band that start with `prefix`.
+        Since the bucket hash of a band is the concatenation of the
+        fixed-width encodings of its rows, these are the buckets agreeing
+        with the query on the leading rows of the band.
+        '''
+        sorted_hashes = self._sorted_hashes(i)
+        j = bisect.bisect_left(sorted_hashes, prefix)
+        while j < len(sorted_hashes) and sorted_hashes[j].startswith(prefix):
+            yield sorted_hashes[j]
+            j += 1
+
+    def _sorted_hashes(self, i):
+        '''
+        Get the sorted bucket hashes of the i-th band, building them or
+        merging the buckets created and removed since the last call.
+        '''
+        sorted_hashes = self.sorted_hashes[i]
+        if sorted_hashes is None:
+            sorted_hashes = self.sorted_hashes[i] = sorted(self.hashtables[i])
+            return sorted_hashes
+        removed, added = self._removed_hashes[i], self._added_hashes[i]
+        if len(removed) + len(added) <= 64:
+            # Shifting the list in place once per hash is cheaper than
+            # copying it for small batches
+            for H in removed:
+                del sorted_hashes[bisect.bisect_left(sorted_hashes, H)]
+            for H in added:
+                bisect.insort(sorted_hashes, H)
+            removed.clear()
+            added.clear()
+            return sorted_hashes
+        # Copy the slices between the positions of the removed and added
+        # hashes, found by binary search
+        merged = []
+        start = 0
+        for j in sorted(bisect.bisect_left(sorted_hashes, H)
+                for H in removed):
+            merged.extend(sorted_hashes[start:j])
+            start = j + 1
+        merged.extend(sorted_hashes[start:])
+        sorted_hashes = merged
+        merged = []
+        start = 0
+        for H in sorted(added):
+            j = bisect.bisect_left(sorted_hashes, H, start)
+            merged.extend(sorted_hashes[start:j])
+            merged.append(H)
+            start = j
+        merged.extend(sorted_hashes[start:])
+        self.sorted_hashes[i] = merged
+        removed.clear()
+        added.clear()
+        return merged
+
+    def get_stats(self, num_largest=10):
+        '''
+        Collect statistics about the current state of the index, useful
+        for tuning the threshold and finding degenerate buckets.
+        Returns a dict with the following entries:
+
+        - `num_keys`: the number of keys in the index.
+        - `num_buckets`: the number of buckets in each band.
+        - `bucket_size_histograms`: for each band, a dict mapping
+          bucket size to the number of buckets with that size.
+        - `largest_buckets`: the `num_largest` largest buckets across
+          all bands as (size, band index, bucket hash) tuples, largest first.
+        - `memory_estimate`: an estimate of the memory used by the index
+          in bytes, excluding the key objects themselves.
+        - `num_overflowed`: for each band, the number of keys that were
+          not stored because their bucket reached `max_bucket_size`.
+        '''
+        histograms = []
+        for hashtable in self.hashtables:
+            histograms.append(dict(collections.Counter(
+                len(bucket) for bucket in hashtable.values())))
+        largest = heapq.nlargest(num_largest,
+                ((len(bucket), i, H) for i, hashtable in
+                    enumerate(self.hashtables)
+                    for H, bucket in hashtable.items()))
+        return {
+            "num_keys" : len(self.keys),
+            "num_buckets" : [len(hashtable) for hashtable in self.hashtables],
+            "bucket_size_histograms" : histograms,
+            "largest_buckets" : largest,
+            "memory_estimate" : self._memory_estimate(),
+            "num_overflowed" : [sum(len(keys) for keys in overflow.values())
+                for overflow in self.overflow],
+        }
+
+    def hot_buckets(self, min_size):
+        '''
+        Find the buckets holding at least `min_size` keys, typically
+        created by boilerplate content shared by many datasets.
+        Returns a list of (band index, bucket hash, size) tuples sorted
+        by size in decreasing order.
+        '''
+        hot = [(i, H, len(bucket)) for i, hashtable in
+                enumerate(self.hashtables)
+                for H, bucket in hashtable.items()
+                if len(bucket) >= min_size]
+        hot.sort(key=lambda x : x[2], reverse=True)
+        return hot
+
+    def _memory_estimate(self):
+        size = sys.getsizeof(self.hashtables) + sys.getsizeof(self.keys)
+        for hashtable in self.hashtables:
+            size += sys.getsizeof(hashtable)
+            for H, bucket in hashtable.items():
+                size += sys.getsizeof(H) + sys.getsizeof(bucket)
+        for overflow in self.overflow:
+            size += sys.getsizeof(overflow)
+            for keys in overflow.values():
+                size += sys.getsizeof(keys)
+        for Hs in self.keys.values():
+            # The bucket hashes are shared with the hash tables
+            size += sys.getsizeof(Hs)
+        return size
+
 
 class WeightedMinHashLSH(MinHashLSH):
     '''
-    The classic MinHash LSH adapted for Weighted MinHash
+    The classic MinHash LSH adapted for Weighted MinHash.
+    It also accepts 0-bit Weighted MinHash objects, i.e.
+    `bBitWeightedMinHash` with b = 0, whose indexes k collide with
+    about the same probability as the full hash values. With b >= 1,
+    b-bit values also collide by chance, so use `bBitMinHashLSH`, which
+    accounts for it, instead.
     '''
 
-    def __init__(self, threshold=0.9, sample_size=128, weights=(0.5,0.5)):
+    def __init__(self, threshold=0.9, sample_size=128, weights=(0.5,0.5),
+            query_hook=None, max_bucket_size=None, params=None):
         '''
         Create an empty `WeightedMinHashLSH` index that accepts 
         WeightedMinHash objects
@@ -171,9 +668,82 @@ class WeightedMinHashLSH(MinHashLSH):
         for the Jaccard similarity threshold.
         `weights` is a tuple in the format of 
         (false_positive_weight, false_negative_weight).
+
+        See `MinHashLSH` for `query_hook`, `max_bucket_size` and `params`.
+        '''
+        super(WeightedMinHashLSH, self).__init__(threshold, sample_size,
+                weights, query_hook, max_bucket_size, params)
+
+    def _hashvalues(self, minhash):
+        if getattr(minhash, "b", 0) != 0:
+            raise ValueError("Expecting Weighted MinHash or 0-bit Weighted "
+                    "MinHash, use bBitMinHashLSH for b = %d" % minhash.b)
+        return super(WeightedMinHashLSH, self)._hashvalues(minhash)
+
+    def _H(self, hs):
+        # The raw bytes of the (k, t) pairs, or of the indexes k of
+        # 0-bit Weighted MinHash, in a fixed width so bucket hashes
+        # of shorter ranges are prefixes of those of longer ranges
+        return np.ascontiguousarray(hs, dtype='<i8').tobytes()
+
+    def _band_keys(self, hashvalues):
+        return self._fixed_width_band_keys(hashvalues)
+
+
+class bBitMinHashLSH(MinHashLSH):
+    '''
+    The classic MinHash LSH adapted for b-bit MinHash, banding directly
+    on the b-bit hash values so the full MinHash are not needed.
+    '''
+
+    def __init__(self, threshold=0.9, num_perm=128, bits=1, density=0.0,
+            weights=(0.5,0.5), query_hook=None, max_bucket_size=None,
+            params=None):
         '''
-        super(WeightedMinHashLSH, self).__init__(threshold, sample_size, weights)
+        Create an empty `bBitMinHashLSH` index that accepts bBitMinHash
+        objects with `num_perm` permutation functions and `bits` bits per
+        hash value (the b of `bBitMinHash`), and query Jaccard similarity
+        threshold `threshold`.
+
+        Two b-bit hash values also collide by chance when the full hash
+        values differ, so a row collides with probability
+        C1 + (1 - C2) * s rather than s for Jaccard similarity s, where
+        C1 and C2 are the constants used by `bBitMinHash.jaccard` for
+        sets of relative size `density` (the r of `bBitMinHash`).
+        The number of bands and rows per band are optimized for this
+        probability, which usually means more rows per band than
+        `MinHashLSH` with the same threshold.
+
+        See `MinHashLSH` for `weights`, `query_hook`, `max_bucket_size`
+        and `params`.
+        '''
+        if bits < 1 or bits > 32:
+            raise ValueError("bits must be an integer in [1, 32]")
+        if density < 0.0 or density > 1.0:
+            raise ValueError("density must be in [0.0, 1.0]")
+        self.bits = bits
+        self.density = density
+        a = bBitMinHash._calc_a(density, bits)
+        self._c1, self._c2 = bBitMinHash._calc_c(a, a, density, density)
+        # Width of a hash value in the bucket hashes
+        self._dtype = '<u1' if bits <= 8 else '<u2' if bits <= 16 else '<u4'
+        super(bBitMinHashLSH, self).__init__(threshold, num_perm, weights,
+                query_hook, max_bucket_size, params)
+
+    def _collision_probability(self, s):
+        return self._c1 + (1 - self._c2) * s
+
+    def _similarity(self, p):
+        return (p - self._c1) / (1 - self._c2)
+
+    def _hashvalues(self, minhash):
+        if minhash.b != self.bits:
+            raise ValueError("Expecting b-bit MinHash with b = %d, got %d"
+                    % (self.bits, minhash.b))
+        return super(bBitMinHashLSH, self)._hashvalues(minhash)
 
     def _H(self, hs):
-        return "".join("%.4x-%.4x" % (k, t) for (k, t) in hs)
+        return np.ascontiguousarray(hs, dtype=self._dtype).tobytes()
 
+    def _band_keys(self, hashvalues):
+        return self._fixed_width_band_keys(hashvalues)
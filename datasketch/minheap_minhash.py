@@ -3,6 +3,8 @@ import hashlib
 import heapq
 import struct
 
+import numpy as np
+
 from datasketch.minhash import MinHash
 
 
@@ -18,6 +20,8 @@ _hash_func_dict = {
     'sha384': hashlib.sha384,
     'md5': hashlib.md5
 }
+# Ids of the hash functions in serialization
+_hash_func_ids = ('sha1', 'sha256', 'sha512', 'sha384', 'md5')
 
 
 class MaxHeapObj(object):
@@ -35,27 +39,30 @@ class MaxHeapObj(object):
 
 
 class UniqueMaxHeap(object):
+    '''
+    The `capacity` smallest distinct values pushed, in a max-heap.
+    '''
+
     def __init__(self, capacity, arr=None):
         self.capacity = capacity
-        self.MAX_VAL = _empty_val
-        if arr:
-            self.heap = map(lambda val: MaxHeapObj(val), arr)
+        if arr is not None:
+            self.heap = [MaxHeapObj(val) for val in arr]
             self.vals = set(arr)
             heapq.heapify(self.heap)
-
-            while len(self.heap) < self.capacity:
-                heapq.heappush(self.heap, MaxHeapObj(self.MAX_VAL))
-
         else:
-            self.heap = [MaxHeapObj(self.MAX_VAL) for _ in range(capacity)]
+            self.heap = []
             self.vals = set()
 
     def push(self, item):
-        if item not in self.vals:
+        if item in self.vals:
+            return
+        if len(self.heap) < self.capacity:
+            self.vals.add(item)
+            heapq.heappush(self.heap, MaxHeapObj(item))
+        elif item < self.heap[0].val:
             self.vals.add(item)
-            value = heapq.heappushpop(self.heap, MaxHeapObj(item)).val
-            if value != self.MAX_VAL:
-                self.vals.remove(value)
+            value = heapq.heapreplace(self.heap, MaxHeapObj(item)).val
+            self.vals.remove(value)
 
     def pop(self):
         value = heapq.heappop(self.heap).val
@@ -63,11 +70,25 @@ class UniqueMaxHeap(object):
         return value
 
     def sorted_values(self):
-        return sorted(map(lambda obj: obj.val, self.heap))
+        return sorted(self.vals)
 
 
 class MinHashMinHeap(MinHash):
-    __slots__ = ('heap', 'hashobj', 'k_val', 'hashstr')
+    '''
+    Bottom-k MinHash, keeping the `k_val` smallest distinct hash values
+    in a heap. `hashvalues` is the sorted list of the values kept, which
+    has fewer than `k_val` values until `k_val` distinct values were
+    seen; `len` is always `k_val`.
+    '''
+
+    __slots__ = ('_heap', '_minheap_array', 'hashobj', 'k_val', 'hashstr')
+
+    # version as uint8
+    # hash function id as uint8
+    # k_val as int32
+    # number of values as int32
+    _serial_fmt_params = '<BBii'
+    _serial_version = 1
 
     def __init__(self, k_val=128, hashobj=None, hashstr='sha1', minheap_array=None):
         if hashobj is None:
@@ -76,10 +97,26 @@ class MinHashMinHeap(MinHash):
             self.hashobj = hashobj
         self.hashstr = hashstr
         self.k_val = k_val
+        # The heap is built from the array of values only when needed
+        self._heap = None
         if minheap_array is not None:
-            self.heap = UniqueMaxHeap(k_val, minheap_array)
+            values = np.unique(np.asarray(minheap_array, dtype=np.uint64))
+            self._minheap_array = values[:k_val].tolist()
         else:
-            self.heap = UniqueMaxHeap(k_val)
+            self._minheap_array = []
+
+    def __len__(self):
+        '''
+        Return the number of hash values the sketch can hold.
+        '''
+        return self.k_val
+
+    @property
+    def heap(self):
+        if self._heap is None:
+            self._heap = UniqueMaxHeap(self.k_val, self._minheap_array)
+            self._minheap_array = None
+        return self._heap
 
     def update(self, b):
         hv = struct.unpack('<I', self.hashobj(b).digest()[:4])[0]
@@ -90,43 +127,52 @@ class MinHashMinHeap(MinHash):
         Returns the size of this MinHash in bytes.
         To be used in serialization.
         '''
-        return struct.calcsize('ii%ds%dI' % (len(self.hashstr), self.k_val))
+        return struct.calcsize(self._serial_fmt_params) + \
+                len(self.hashvalues) * struct.calcsize('I')
 
     def serialize(self, buf):
         '''
         Serializes this MinHash into bytes, store in `buf`.
         This is more efficient than using pickle.dumps on the object.
+        The hash function is stored as an id, followed by the sorted
+        values written through a NumPy view of the buffer.
         '''
         if len(buf) < self.bytesize():
             raise ValueError("The buffer does not have enough space\
                     for holding this MinHash.")
-        fmt = "ii%ds%dI" % (len(self.hashstr), self.k_val)
-        struct.pack_into(fmt, buf, 0, self.k_val, len(self.hashstr), self.hashstr, *self.hashvalues)
+        if self.hashstr not in _hash_func_ids:
+            raise ValueError("Cannot serialize MinHash with hash function %s"
+                    % self.hashstr)
+        hashvalues = self.hashvalues
+        struct.pack_into(self._serial_fmt_params, buf, 0,
+                self._serial_version, _hash_func_ids.index(self.hashstr),
+                self.k_val, len(hashvalues))
+        offset = struct.calcsize(self._serial_fmt_params)
+        np.frombuffer(buf, dtype='<u4', count=len(hashvalues),
+                offset=offset)[:] = hashvalues
 
     @classmethod
     def deserialize(cls, buf):
         '''
         Reconstruct a MinHash from a byte buffer.
         This is more efficient than using the pickle.loads on the pickled
-        bytes.
+        bytes. The heap is only rebuilt when the MinHash is updated or
+        compared.
         '''
         try:
-            k_val, = struct.unpack_from('i', buf, 0)
+            version, hash_id, k_val, num_values = \
+                    struct.unpack_from(cls._serial_fmt_params, buf, 0)
         except TypeError:
-            k_val, = struct.unpack_from('i', buffer(buf), 0)
-        offset = struct.calcsize('i')
-        try:
-            hashstr_len, = struct.unpack_from('i', buf, offset)
-        except TypeError:
-            hashstr_len, = struct.unpack_from('i', buffer(buf), offset)
-        offset += struct.calcsize('i')
-        try:
-            out = struct.unpack_from('%ds%dI' % (hashstr_len, k_val), buf, offset)
-        except TypeError:
-            out = struct.unpack_from('%ds%dI' % (hashstr_len, k_val), buffer(buf), offset)
-        hashstr = out[0]
-        minheap_array = out[1:]
-        return cls(k_val=k_val, minheap_array=minheap_array, hashstr=hashstr)
+            version, hash_id, k_val, num_values = \
+                    struct.unpack_from(cls._serial_fmt_params, buffer(buf), 0)
+        if version != cls._serial_version:
+            raise ValueError("Unsupported serialization format version %d"
+                    % version)
+        offset = struct.calcsize(cls._serial_fmt_params)
+        minheap_array = np.frombuffer(buf, dtype='<u4', count=num_values,
+                offset=offset)
+        return cls(k_val=k_val, minheap_array=minheap_array,
+                   hashstr=_hash_func_ids[hash_id])
 
     def __getstate__(self):
         '''
@@ -136,8 +182,7 @@ class MinHashMinHeap(MinHash):
         the same as the buffer returned by this function.
         '''
         buf = bytearray(self.bytesize())
-        fmt = "ii%ds%dI" % (len(self.hashstr), self.k_val)
-        struct.pack_into(fmt, buf, 0, self.k_val, len(self.hashstr), self.hashstr, *self.hashvalues)
+        self.serialize(buf)
         return buf
 
     def __setstate__(self, buf):
@@ -147,26 +192,14 @@ class MinHashMinHeap(MinHash):
         Note that the input buffer is not the same as the input to the
         Python pickle.loads function.
         '''
-        try:
-            k_val, = struct.unpack_from('i', buf, 0)
-        except TypeError:
-            k_val, = struct.unpack_from('i', buffer(buf), 0)
-        offset = struct.calcsize('i')
-        try:
-            hashstr_len, = struct.unpack_from('i', buf, offset)
-        except TypeError:
-            hashstr_len, = struct.unpack_from('i', buffer(buf), offset)
-        offset += struct.calcsize('i')
-        try:
-            out = struct.unpack_from('%ds%dI' % (hashstr_len, k_val), buf, offset)
-        except TypeError:
-            out = struct.unpack_from('%ds%dI' % (hashstr_len, k_val), buffer(buf), offset)
-        hashstr = out[0]
-        minheap_array = out[1:]
-        self.__init__(k_val=k_val, minheap_array=minheap_array, hashstr=hashstr)
+        other = self.deserialize(buf)
+        self.__init__(k_val=other.k_val, hashstr=other.hashstr,
+                      minheap_array=other.hashvalues)
 
     @property
     def hashvalues(self):
+        if self._heap is None:
+            return list(self._minheap_array)
         return self.heap.sorted_values()
 
     @property
@@ -174,7 +207,9 @@ class MinHashMinHeap(MinHash):
         return self.heap.vals
 
     def is_empty(self):
-        return len(self.heap.vals) == 0
+        if self._heap is None:
+            return len(self._minheap_array) == 0
+        return len(self._heap.vals) == 0
 
     def jaccard(self, other):
         if self.k_val != other.k_val:
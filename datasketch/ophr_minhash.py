@@ -11,6 +11,9 @@ _mersenne_prime = (1 << 61) - 1
 _max_hash = (1 << 32) - 2
 _empty_val = _max_hash + 1
 _hash_range = (1 << 32)
+# Prime of the 2-universal hash functions choosing donor bins
+_donor_prime = (1 << 31) - 1
+_donor_params = dict()
 _hash_func_dict = {
     'sha1': hashlib.sha1,
     'sha256': hashlib.sha256,
@@ -18,12 +21,52 @@ _hash_func_dict = {
     'sha384': hashlib.sha384,
     'md5': hashlib.md5
 }
+# Ids of the hash functions and densification schemes in serialization
+_hash_func_ids = ('sha1', 'sha256', 'sha512', 'sha384', 'md5')
+_densifications = ('rotation', 'optimal')
+
+
+def _donor_hash_params(k_val):
+    '''
+    The parameters (a, b) of the 2-universal hash function of each bin,
+    used by the optimal densification. They only depend on the number
+    of bins, so all sketches with the same `k_val` share them.
+    '''
+    if k_val not in _donor_params:
+        gen = np.random.RandomState(k_val)
+        _donor_params[k_val] = (
+                gen.randint(1, _donor_prime, k_val).astype(np.uint64),
+                gen.randint(0, _donor_prime, k_val).astype(np.uint64))
+    return _donor_params[k_val]
 
 
 class MinHashOPHR(MinHash):
-    __slots__ = ('_hashvalues', '_dense_hashvalues', 'hashobj', 'k_val', 'rot_constant', 'hashstr')
+    '''
+    MinHash using One Permutation Hashing: a single hash function splits
+    the hash space into `k_val` bins, and each bin keeps its minimum.
+    Empty bins are filled in by densification, either `'rotation'`
+    (the default), borrowing the value of the next non-empty bin plus
+    `rot_constant` times the distance, or `'optimal'`, copying the value
+    of a non-empty bin chosen by a 2-universal hash function of the
+    empty bin, which has lower variance for sparse sets.
+    http://proceedings.mlr.press/v70/shrivastava17a/shrivastava17a.pdf
+    '''
+
+    __slots__ = ('_hashvalues', '_dense_hashvalues', 'hashobj', 'k_val', 'rot_constant', 'hashstr',
+                 'densification')
 
-    def __init__(self, k_val=128, hashobj=None, hashstr='sha1', _hashvalues=None):
+    # version as uint8
+    # hash function id as uint8
+    # densification id as uint8
+    # k_val as int32
+    _serial_fmt_params = '<BBBi'
+    _serial_version = 1
+
+    def __init__(self, k_val=128, hashobj=None, hashstr='sha1', _hashvalues=None,
+                 densification='rotation'):
+        if densification not in _densifications:
+            raise ValueError("densification must be 'rotation' or 'optimal'")
+        self.densification = densification
         if hashobj is None:
             self.hashobj = _hash_func_dict[hashstr]
         else:
@@ -50,48 +93,76 @@ class MinHashOPHR(MinHash):
         self._hashvalues[bucket] = min(self._hashvalues[bucket], hv)
         self._dense_hashvalues = None
 
+    def update_batch(self, bs):
+        '''
+        Update this MinHash with many values at once, given as an iterable
+        of bytes. This is equivalent to calling `update` on each value,
+        but the bins are updated in a single vectorized step.
+        '''
+        digests = b''.join(self.hashobj(b).digest()[:4] for b in bs)
+        self._update_batch(np.frombuffer(digests, dtype='<u4'))
+
+    def _update_batch(self, hvs):
+        hvs = np.asarray(hvs).astype(self._hashvalues.dtype)
+        if hvs.size == 0:
+            return
+        buckets = hvs % self.k_val
+        np.minimum.at(self._hashvalues, buckets, hvs)
+        self._dense_hashvalues = None
+
+    def _hash_id(self):
+        if self.hashstr not in _hash_func_ids:
+            raise ValueError("Cannot serialize MinHash with hash function %s"
+                    % self.hashstr)
+        return _hash_func_ids.index(self.hashstr)
+
     def bytesize(self):
         '''
         Returns the size of this MinHash in bytes.
         To be used in serialization.
         '''
-        return struct.calcsize('ii%ds%dI' % (len(self.hashstr), self.k_val))
+        return struct.calcsize(self._serial_fmt_params) + \
+                self.k_val * struct.calcsize('I')
 
     def serialize(self, buf):
         '''
         Serializes this MinHash into bytes, store in `buf`.
         This is more efficient than using pickle.dumps on the object.
+        The hash function is stored as an id, and the bins are written
+        through a NumPy view of the buffer.
         '''
         if len(buf) < self.bytesize():
             raise ValueError("The buffer does not have enough space\
                     for holding this MinHash.")
-        fmt = "ii%ds%dI" % (len(self.hashstr), self.k_val)
-        struct.pack_into(fmt, buf, 0, self.k_val, len(self.hashstr), self.hashstr, *self._hashvalues)
+        struct.pack_into(self._serial_fmt_params, buf, 0,
+                self._serial_version, self._hash_id(),
+                _densifications.index(self.densification), self.k_val)
+        offset = struct.calcsize(self._serial_fmt_params)
+        np.frombuffer(buf, dtype='<u4', count=self.k_val,
+                offset=offset)[:] = self._hashvalues
 
     @classmethod
     def deserialize(cls, buf):
         '''
         Reconstruct a MinHash from a byte buffer.
         This is more efficient than using the pickle.loads on the pickled
-        bytes.
+        bytes. The densified hash values are only computed when needed.
         '''
         try:
-            k_val, = struct.unpack_from('i', buf, 0)
+            version, hash_id, densification, k_val = \
+                    struct.unpack_from(cls._serial_fmt_params, buf, 0)
         except TypeError:
-            k_val, = struct.unpack_from('i', buffer(buf), 0)
-        offset = struct.calcsize('i')
-        try:
-            hashstr_len, = struct.unpack_from('i', buf, offset)
-        except TypeError:
-            hashstr_len, = struct.unpack_from('i', buffer(buf), offset)
-        offset += struct.calcsize('i')
-        try:
-            out = struct.unpack_from('%ds%dI' % (hashstr_len, k_val), buf, offset)
-        except TypeError:
-            out = struct.unpack_from('%ds%dI' % (hashstr_len, k_val), buffer(buf), offset)
-        hashstr = out[0]
-        _hashvalues = out[1:]
-        return cls(k_val=k_val, _hashvalues=np.array(_hashvalues), hashstr=hashstr)
+            version, hash_id, densification, k_val = \
+                    struct.unpack_from(cls._serial_fmt_params, buffer(buf), 0)
+        if version != cls._serial_version:
+            raise ValueError("Unsupported serialization format version %d"
+                    % version)
+        offset = struct.calcsize(cls._serial_fmt_params)
+        _hashvalues = np.frombuffer(buf, dtype='<u4', count=k_val,
+                offset=offset).astype(np.uint64)
+        return cls(k_val=k_val, hashstr=_hash_func_ids[hash_id],
+                   _hashvalues=_hashvalues,
+                   densification=_densifications[densification])
 
     def __getstate__(self):
         '''
@@ -101,8 +172,7 @@ class MinHashOPHR(MinHash):
         the same as the buffer returned by this function.
         '''
         buf = bytearray(self.bytesize())
-        fmt = "ii%ds%dI" % (len(self.hashstr), self.k_val)
-        struct.pack_into(fmt, buf, 0, self.k_val, len(self.hashstr), self.hashstr, *self._hashvalues)
+        self.serialize(buf)
         return buf
 
     def __setstate__(self, buf):
@@ -112,49 +182,128 @@ class MinHashOPHR(MinHash):
         Note that the input buffer is not the same as the input to the
         Python pickle.loads function.
         '''
-        try:
-            k_val, = struct.unpack_from('i', buf, 0)
-        except TypeError:
-            k_val, = struct.unpack_from('i', buffer(buf), 0)
-        offset = struct.calcsize('i')
-        try:
-            hashstr_len, = struct.unpack_from('i', buf, offset)
-        except TypeError:
-            hashstr_len, = struct.unpack_from('i', buffer(buf), offset)
-        offset += struct.calcsize('i')
-        try:
-            out = struct.unpack_from('%ds%dI' % (hashstr_len, k_val), buf, offset)
-        except TypeError:
-            out = struct.unpack_from('%ds%dI' % (hashstr_len, k_val), buffer(buf), offset)
-        hashstr = out[0]
-        _hashvalues = out[1:]
-        self.__init__(k_val=k_val, _hashvalues=np.array(_hashvalues), hashstr=hashstr)
+        other = self.deserialize(buf)
+        self.__init__(k_val=other.k_val, hashstr=other.hashstr,
+                      _hashvalues=other._hashvalues,
+                      densification=other.densification)
 
     @property
     def hashvalues(self):
         if self._dense_hashvalues is None:
-            self._dense_hashvalues = copy.copy(self._hashvalues)
-            for i in range(len(self._hashvalues)):
-                if self._hashvalues[i] == _empty_val:
-                    j = (i + 1) % self.k_val
-                    distance = 1
-                    while j != i:
-                        if self._hashvalues[j] != _empty_val:
-                            self._dense_hashvalues[i] = (self._hashvalues[j] + self.rot_constant * distance) % _max_hash
-                            break
-                        j = (j + 1) % self.k_val
-                        distance += 1
+            self._dense_hashvalues = self._densify()
         return self._dense_hashvalues
 
+    def _densify(self):
+        '''
+        Fill every empty bin with the value of the next non-empty bin,
+        wrapping around, rotated by `rot_constant` times the distance
+        between the two bins.
+        '''
+        dense = copy.copy(self._hashvalues)
+        empty = self._hashvalues == _empty_val
+        if not np.any(empty) or np.all(empty):
+            return dense
+        if self.densification == 'optimal':
+            return self._densify_optimal(dense, empty)
+        # Index of the next non-empty bin at or after each position of
+        # the bins repeated twice, which handles the wraparound
+        k = self.k_val
+        positions = np.arange(2 * k)
+        nonempty = np.where(np.tile(~empty, 2), positions, 2 * k)
+        following = np.minimum.accumulate(nonempty[::-1])[::-1][:k]
+        i = np.nonzero(empty)[0]
+        distance = following[i] - i
+        donors = self._hashvalues[following[i] % k]
+        dense[i] = (donors + self.rot_constant * distance) % _max_hash
+        return dense
+
+    def _densify_optimal(self, dense, empty):
+        '''
+        Fill every empty bin i with the value of the first non-empty bin
+        in the sequence h_i(1), h_i(2), ... of its 2-universal hash
+        function. The empty bins are probed together, a batch of about
+        twice the expected number of probes at a time, bounded to keep
+        the batch under a million probes.
+        '''
+        k = self.k_val
+        i = np.nonzero(empty)[0]
+        if i.size == k - 1:
+            # Every probe sequence ends at the only non-empty bin
+            dense[i] = self._hashvalues[~empty][0]
+            return dense
+        a, b = _donor_hash_params(k)
+        a, b = a[i, np.newaxis], b[i, np.newaxis]
+        num_probes = min(2 * k // (k - i.size) + 1,
+                max(1, (1 << 20) // i.size))
+        t = np.arange(1, num_probes + 1, dtype=np.uint64)
+        while i.size:
+            j = ((a * t + b) % np.uint64(_donor_prime)) % np.uint64(k)
+            found = ~empty[j]
+            # The first non-empty donor of each bin, if any was probed
+            first = np.argmax(found, axis=1)
+            done = found[np.arange(i.size), first]
+            dense[i[done]] = self._hashvalues[j[done, first[done]]]
+            i, a, b = i[~done], a[~done], b[~done]
+            t += np.uint64(num_probes)
+        return dense
+
     def is_empty(self):
         return not np.any(self._hashvalues != _empty_val)
 
+    def merge(self, other):
+        '''
+        Merge the other MinHashOPHR with this one, making this the union
+        of both, bin by bin.
+        '''
+        self._check_compatible(other)
+        self._hashvalues = np.minimum(self._hashvalues, other._hashvalues)
+        self._dense_hashvalues = None
+
+    @classmethod
+    def union(cls, *mhs):
+        '''
+        Return the union MinHashOPHR of multiple MinHashOPHR.
+        '''
+        if len(mhs) < 2:
+            raise ValueError("Cannot union less than 2 MinHash")
+        for m in mhs[1:]:
+            mhs[0]._check_compatible(m)
+        _hashvalues = np.minimum.reduce([m._hashvalues for m in mhs])
+        return cls(k_val=mhs[0].k_val, hashobj=mhs[0].hashobj,
+                   hashstr=mhs[0].hashstr, _hashvalues=_hashvalues,
+                   densification=mhs[0].densification)
+
+    def count(self):
+        '''
+        Estimate the cardinality count from the number of empty bins
+        (linear counting), or from the bin minimums when no bin is empty.
+        '''
+        num_empty = np.count_nonzero(self._hashvalues == _empty_val)
+        k = float(self.k_val)
+        if num_empty > 0:
+            return k * np.log(k / num_empty)
+        # Each bin holds the minimum of about n/k uniform hash values
+        return k * (k / np.sum(self._hashvalues / float(_hash_range)) - 1.0)
+
+    def _check_compatible(self, other):
+        if not isinstance(other, MinHashOPHR):
+            raise ValueError("Cannot merge MinHashOPHR with non-MinHashOPHR")
+        if self.k_val != other.k_val:
+            raise ValueError("Cannot merge MinHashOPHR with\
+                    different numbers of bins")
+        if self.hashobj != other.hashobj:
+            raise ValueError("Cannot merge MinHashOPHR with\
+                    different hash functions")
+
     def jaccard(self, other):
         if self.k_val != len(other):
             raise ValueError("Cannot compute Jaccard given MinHash with\
                     different numbers of permutation functions")
         if not isinstance(other, MinHashOPHR):
             raise ValueError("Cannot compute Jaccard of non-MinHashOPHR")
+        if self.densification != other.densification:
+            raise ValueError("Cannot compute Jaccard given MinHashOPHR with\
+                    different densification schemes")
 
         return np.float(np.count_nonzero(self.hashvalues == other.hashvalues)) / \
                np.float(self.k_val)
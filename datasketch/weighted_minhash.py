@@ -3,12 +3,69 @@ This Weighted MinHash is based on Sergey Ioffe's paper,
 Improved Consistent Sampling, Weighted Minhash and L1 Sketching,
 http://static.googleusercontent.com/media/research.google.com/en//pubs/archive/36928.pdf
 '''
-import collections
+import collections, threading, copy, struct
+from multiprocessing.pool import ThreadPool
 import numpy as np
 
+try:
+    from scipy.sparse import issparse
+except ImportError:
+    # For when no scipy installed
+    issparse = lambda v : False
+
+# The maximum number of elements in each of the temporary
+# (sample_size, number of dimensions) arrays used in computing the hash values
+_max_chunk_size = 1 << 16
+
+# Number of random numbers derived for each (sample, dimension)
+# in the lazy mode of WeightedMinHashGenerator
+_num_streams = 5
+
+
+def _splitmix64(x):
+    '''
+    The finalizer of the SplitMix64 generator, applied element-wise to an
+    uint64 array: a bijective mixing function whose outputs for
+    consecutive counters are statistically independent.
+    http://xorshift.di.unimi.it/splitmix64.c
+    '''
+    z = x + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def _uniform(x):
+    '''
+    Map uint64 values to floats uniformly distributed in the open
+    interval (0, 1), using the upper 53 bits.
+    '''
+    return ((x >> np.uint64(11)).astype(np.float64) + 0.5) / float(1 << 53)
+
+
+# The integer types used to serialize the hash values,
+# from the narrowest to the widest
+_serial_k_types = ('B', 'H', 'I', 'Q')
+_serial_t_types = ('b', 'h', 'i', 'q')
+
+
+def _narrowest_type(types, low, high):
+    for c in types:
+        info = np.iinfo(np.dtype(c))
+        if info.min <= low and high <= info.max:
+            return c
+    raise ValueError("Hash values out of range for serialization")
+
 
 class WeightedMinHash(object):
 
+    # format version as uint8
+    # seed as int64
+    # sample_size as int32
+    # type codes of k and t as char
+    _serial_fmt_params = '<Bqicc'
+    _serial_version = 1
+
     def __init__(self, seed, hashvalues):
         '''
         Create a WeightedMinHash object given the seed
@@ -54,45 +111,489 @@ class WeightedMinHash(object):
             raise ValueError("Cannot compute Jaccard given WeightedMinHash objects with\
                     different numbers of hash values")
         # Check how many pairs of (k, t) hashvalues are equal
-        intersection = 0
-        for this, that in zip(self.hashvalues, other.hashvalues):
-            if np.array_equal(this, that):
-                intersection += 1
+        intersection = np.count_nonzero(
+                np.all(self.hashvalues == other.hashvalues, axis=1))
         return float(intersection) / float(len(self))
+
+    def jaccard_many(self, others):
+        '''
+        Estimate the Jaccard similarities between this WeightedMinHash and
+        many others at once. `others` is either a list of WeightedMinHash
+        objects, or an array of stacked hash values of shape
+        (n, sample_size, 2), as returned by
+        `WeightedMinHashGenerator.minhash_many`, which must have been
+        created with the same seed.
+        Returns an array of n similarities.
+        '''
+        if len(others) == 0:
+            return np.zeros(0)
+        if not isinstance(others, np.ndarray):
+            if any(other.seed != self.seed for other in others):
+                raise ValueError("Cannot compute Jaccard given WeightedMinHash objects with\
+                        different seeds")
+            others = np.array([other.hashvalues for other in others])
+        if others.shape[1:] != self.hashvalues.shape:
+            raise ValueError("Cannot compute Jaccard given WeightedMinHash objects with\
+                    different numbers of hash values")
+        intersection = np.count_nonzero(
+                np.all(others == self.hashvalues, axis=2), axis=1)
+        return intersection / float(len(self))
+
+    def _serial_types(self):
+        k, t = self.hashvalues[:, 0], self.hashvalues[:, 1]
+        if len(self) == 0:
+            return _serial_k_types[0], _serial_t_types[0]
+        return _narrowest_type(_serial_k_types, k.min(), k.max()), \
+                _narrowest_type(_serial_t_types, t.min(), t.max())
+
+    def bytesize(self):
+        '''
+        Returns the size of this WeightedMinHash in bytes.
+        To be used in serialization.
+        The indexes k and the values t of the hash values are stored using
+        the narrowest integer types that can hold them.
+        '''
+        k_type, t_type = self._serial_types()
+        return struct.calcsize(self._serial_fmt_params) + len(self) * \
+                (struct.calcsize(k_type) + struct.calcsize(t_type))
+
+    def serialize(self, buf):
+        '''
+        Serializes this WeightedMinHash into bytes, store in `buf`.
+        This is more efficient than using pickle.dumps on the object.
+        '''
+        if len(buf) < self.bytesize():
+            raise ValueError("The buffer does not have enough space\
+                    for holding this WeightedMinHash.")
+        k_type, t_type = self._serial_types()
+        struct.pack_into(self._serial_fmt_params, buf, 0,
+                self._serial_version, self.seed, len(self),
+                k_type.encode("ascii"), t_type.encode("ascii"))
+        offset = struct.calcsize(self._serial_fmt_params)
+        for i, c in enumerate((k_type, t_type)):
+            dtype = np.dtype('<' + c)
+            np.frombuffer(buf, dtype=dtype, count=len(self),
+                    offset=offset)[:] = self.hashvalues[:, i]
+            offset += len(self) * dtype.itemsize
+
+    @classmethod
+    def deserialize(cls, buf):
+        '''
+        Reconstruct a WeightedMinHash from a byte buffer.
+        This is more efficient than using the pickle.loads on the pickled
+        bytes: the hash values are read through NumPy views of the buffer
+        and copied once into the hash values array.
+        '''
+        try:
+            version, seed, sample_size, k_type, t_type = \
+                    struct.unpack_from(cls._serial_fmt_params, buf, 0)
+        except TypeError:
+            version, seed, sample_size, k_type, t_type = \
+                    struct.unpack_from(cls._serial_fmt_params, buffer(buf), 0)
+        if version != cls._serial_version:
+            raise ValueError("Unsupported serialization format version %d"
+                    % version)
+        offset = struct.calcsize(cls._serial_fmt_params)
+        hashvalues = np.zeros((sample_size, 2), dtype=np.int64)
+        for i, c in enumerate((k_type, t_type)):
+            dtype = np.dtype('<' + c.decode("ascii"))
+            hashvalues[:, i] = np.frombuffer(buf, dtype=dtype,
+                    count=sample_size, offset=offset)
+            offset += sample_size * dtype.itemsize
+        return cls(seed, hashvalues)
+
+    def __getstate__(self):
+        '''
+        This function is called when pickling the WeightedMinHash.
+        Returns a bytearray which will then be pickled.
+        Note that the bytes returned by the Python pickle.dumps is not
+        the same as the buffer returned by this function.
+        '''
+        buf = bytearray(self.bytesize())
+        self.serialize(buf)
+        return buf
+
+    def __setstate__(self, buf):
+        '''
+        This function is called when unpickling the WeightedMinHash.
+        Initialize the object with data in the buffer.
+        Note that the input buffer is not the same as the input to the
+        Python pickle.loads function.
+        '''
+        other = self.deserialize(buf)
+        self.__init__(other.seed, other.hashvalues)
  
 
 class WeightedMinHashGenerator(object):
 
-    def __init__(self, dim, sample_size=128, seed=1):
+    def __init__(self, dim, sample_size=128, seed=1, lazy=False,
+            cache_size=0, dtype=np.float64):
         '''
         Initialize the generator with the number of dimensions of input 
         vectors, number of samples, and the seed for creating random parameters.
+
+        By default the random parameters are generated up front, as
+        three (sample_size, dim) matrices `rs`, `ln_cs` and `betas`.
+        Set `lazy` to True for very large `dim`: the parameters of each
+        (sample, dimension) are then derived deterministically from
+        the seed and their position using a counter-based generator, only
+        for the dimensions touched by the input vectors. This is best
+        combined with sparse inputs. The lazy parameters are different
+        from the eager ones, so hash values created in different modes
+        are not comparable.
+        `cache_size` is the maximum number of dimensions whose derived
+        parameters are kept in a LRU cache in the lazy mode.
+
+        `dtype` is the floating point type of the random parameters and of
+        the computation of the hash values, either `np.float64` or
+        `np.float32`. With `np.float32` the parameters are the float64 ones
+        rounded, halving the memory used and the memory bandwidth
+        needed in `minhash`. The Jaccard estimates are unchanged within
+        the sampling error, although individual hash values may differ
+        from the float64 ones.
+        See `benchmark/weighted_minhash_float32_benchmark.py`.
         '''
+        if np.dtype(dtype) not in (np.float32, np.float64):
+            raise ValueError("dtype must be np.float32 or np.float64")
         self.dim = dim
         self.sample_size = sample_size
         self.seed = seed
+        self.lazy = lazy
+        self.cache_size = cache_size
+        self.dtype = np.dtype(dtype)
+        if lazy:
+            self._key = _splitmix64(np.array([seed], dtype=np.uint64))[0]
+            self._cache = collections.OrderedDict()
+            self._cache_lock = threading.Lock()
+            return
         generator = np.random.RandomState(seed=seed)
-        self.rs = generator.gamma(2, 1, (sample_size, dim))
-        self.ln_cs = np.log(generator.gamma(2, 1, (sample_size, dim)))
-        self.betas = generator.uniform(0, 1, (sample_size, dim))
+        self.rs = generator.gamma(2, 1, (sample_size, dim))\
+                .astype(self.dtype, copy=False)
+        self.ln_cs = np.log(generator.gamma(2, 1, (sample_size, dim)))\
+                .astype(self.dtype, copy=False)
+        self.betas = generator.uniform(0, 1, (sample_size, dim))\
+                .astype(self.dtype, copy=False)
+
+    def __getstate__(self):
+        '''
+        This function is called when pickling the generator.
+        The cache and its lock of the lazy mode are not pickled.
+        '''
+        state = self.__dict__.copy()
+        state.pop("_cache", None)
+        state.pop("_cache_lock", None)
+        return state
+
+    def __setstate__(self, state):
+        '''
+        This function is called when unpickling the generator.
+        The lazy mode starts again with an empty cache.
+        '''
+        self.__dict__.update(state)
+        if self.lazy:
+            self._cache = collections.OrderedDict()
+            self._cache_lock = threading.Lock()
 
     def minhash(self, v):
         '''
         Takes a vector of weights as input and returns a
         WeightedMinHash object.
+        The vector can be dense (any iterable of length `dim`), or sparse:
+        a dict mapping dimension indices to weights, or a `scipy.sparse`
+        matrix with a single row. Sparse vectors are only evaluated over
+        their nonzero dimensions, see `minhash_sparse`.
         '''
+        if isinstance(v, dict):
+            return self.minhash_sparse(list(v.keys()), list(v.values()))
+        if issparse(v):
+            if v.shape != (1, self.dim):
+                raise ValueError("Input dimension mismatch, expecting "
+                        "a sparse row of shape (1, %d)" % self.dim)
+            v = v.tocsr()
+            v.sum_duplicates()
+            return self.minhash_sparse(v.indices, v.data)
         if not isinstance(v, collections.Iterable):
             raise TypeError("Input vector must be an iterable")
         if not len(v) == self.dim:
             raise ValueError("Input dimension mismatch, expecting %d" % self.dim)
         if not isinstance(v, np.ndarray):
             v = np.array(v)
-        hashvalues = np.zeros((self.sample_size, 2), dtype=np.int)
-        for i in range(self.sample_size):
-            t = np.floor((np.log(v) / self.rs[i]) + self.betas[i])
-            ln_y = (t - self.betas[i]) * self.rs[i]
-            ln_a = self.ln_cs[i] - ln_y - self.rs[i]
-            k = np.argmin(ln_a)
-            hashvalues[i][0], hashvalues[i][1] = k, int(t[k])
+        if not np.any(v > 0):
+            raise ValueError("Input vector must have at least one nonzero "
+                    "weight")
+        hashvalues = self._icws(np.log(v))
+        return WeightedMinHash(self.seed, hashvalues)
+
+    def minhash_sparse(self, indices, weights):
+        '''
+        Takes a sparse vector of weights, given by the indices of its
+        nonzero dimensions and the corresponding weights, and returns a
+        WeightedMinHash object.
+        Only the nonzero dimensions are evaluated, so the cost does not
+        depend on `dim`. The result is the same as the one of `minhash`
+        on the equivalent dense vector.
+        '''
+        hashvalues = self._sparse_hashvalues(indices, weights)
         return WeightedMinHash(self.seed, hashvalues)
 
+    def minhash_many(self, X, num_threads=None, chunk_size=256):
+        '''
+        Takes a matrix `X` with one vector of weights per row, either
+        a dense 2-D array-like of shape (n, `dim`) or a `scipy.sparse`
+        matrix, and returns the hash values of all rows as an array of
+        shape (n, `sample_size`, 2), whose i-th entry holds the hash values
+        of the WeightedMinHash `minhash` would return for the i-th row.
+        No WeightedMinHash objects are created, and sparse rows are
+        only evaluated over their nonzero dimensions.
+
+        The rows are processed in chunks of `chunk_size` rows, so
+        that the temporary memory used does not depend on the number
+        of rows. If `num_threads` is greater than 1, the chunks are
+        processed in a pool of that many threads; NumPy releases the GIL
+        in the heavy computations so the threads run in parallel.
+        '''
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        if issparse(X):
+            if X.shape[1] != self.dim:
+                raise ValueError("Input dimension mismatch, expecting %d "
+                        "columns" % self.dim)
+            X = X.tocsr()
+            if not X.has_canonical_format:
+                X = X.copy()
+                X.sum_duplicates()
+            row = lambda i : self._sparse_hashvalues(
+                    X.indices[X.indptr[i]:X.indptr[i+1]],
+                    X.data[X.indptr[i]:X.indptr[i+1]])
+        else:
+            X = np.asarray(X)
+            if X.ndim != 2 or X.shape[1] != self.dim:
+                raise ValueError("Input dimension mismatch, expecting "
+                        "a matrix with %d columns" % self.dim)
+            if not np.all(np.any(X > 0, axis=1)):
+                raise ValueError("Input vectors must have at least one "
+                        "nonzero weight")
+            row = lambda i : self._icws(np.log(X[i]))
+        num_rows = X.shape[0]
+        hashvalues = np.zeros((num_rows, self.sample_size, 2), dtype=np.int64)
+        def process_chunk(start):
+            for i in range(start, min(start + chunk_size, num_rows)):
+                hashvalues[i] = row(i)
+        starts = range(0, num_rows, chunk_size)
+        if num_threads is None or num_threads <= 1:
+            for start in starts:
+                process_chunk(start)
+        else:
+            pool = ThreadPool(num_threads)
+            try:
+                pool.map(process_chunk, starts)
+            finally:
+                pool.close()
+                pool.join()
+        return hashvalues
+
+    def _sparse_hashvalues(self, indices, weights):
+        '''
+        Validate the sparse vector given by `indices` and `weights` and
+        compute its hash values over the nonzero dimensions.
+        '''
+        indices = np.asarray(indices, dtype=np.int64).ravel()
+        weights = np.asarray(weights, dtype=np.float64).ravel()
+        if len(indices) != len(weights):
+            raise ValueError("Indices and weights must have the same length")
+        if np.any(weights < 0):
+            raise ValueError("Weights must be non-negative")
+        nonzero = weights > 0
+        indices, weights = indices[nonzero], weights[nonzero]
+        if len(indices) == 0:
+            raise ValueError("Input vector must have at least one "
+                    "nonzero weight")
+        if indices.min() < 0 or indices.max() >= self.dim:
+            raise ValueError("Input dimension mismatch, expecting "
+                    "indices in [0, %d)" % self.dim)
+        # Sort by index so ties are broken in the same way as for
+        # dense vectors
+        order = np.argsort(indices, kind="mergesort")
+        indices, weights = indices[order], weights[order]
+        if np.any(indices[1:] == indices[:-1]):
+            raise ValueError("Duplicate indices in the input vector")
+        return self._icws(np.log(weights), indices)
+
+    def _icws(self, ln_v, dims=None):
+        '''
+        Compute the hash values of all samples at once given the logarithm
+        of the weights `ln_v`, for the dimensions `dims` (an increasing
+        array of indices) or for all dimensions if `dims` is None.
+        '''
+        return self._icws_min(ln_v, dims)[0]
+
+    def _icws_min(self, ln_v, dims=None):
+        '''
+        Same as `_icws`, but also returns the minimum ln(a) of each sample,
+        which selected the hash values.
+        The dimensions are processed in chunks to bound the size of the
+        temporary (sample_size, number of dimensions) arrays.
+        '''
+        hashvalues = np.zeros((self.sample_size, 2), dtype=np.int64)
+        ln_v = ln_v.astype(self.dtype, copy=False)
+        min_ln_a = np.full(self.sample_size, np.inf, dtype=self.dtype)
+        samples = np.arange(self.sample_size)
+        step = max(1, _max_chunk_size // self.sample_size)
+        num_dims = self.dim if dims is None else len(dims)
+        for start in range(0, num_dims, step):
+            end = min(start + step, num_dims)
+            cols = slice(start, end) if dims is None else dims[start:end]
+            rs, ln_cs, betas = self._params(cols)
+            # Same as the formulas in the paper, but computed in place
+            # to avoid allocating more temporary arrays
+            t = np.divide(ln_v[start:end], rs)
+            t += betas
+            np.floor(t, out=t)
+            ln_a = np.subtract(t, betas)
+            ln_a *= rs
+            np.subtract(ln_cs, ln_a, out=ln_a)
+            ln_a -= rs
+            k = np.argmin(ln_a, axis=1)
+            ln_a = ln_a[samples, k]
+            # Keep the earlier dimension on ties, as a single argmin would
+            better = ln_a < min_ln_a
+            min_ln_a[better] = ln_a[better]
+            k_dims = k + start if dims is None else cols[k]
+            hashvalues[better, 0] = k_dims[better]
+            hashvalues[better, 1] = t[samples, k][better]
+        return hashvalues, min_ln_a
+
+    def _params(self, cols):
+        '''
+        Get the random parameters (rs, ln_cs, betas) of the dimensions
+        `cols`, a slice or an array of indices, as (sample_size, len(cols))
+        arrays.
+        '''
+        if not self.lazy:
+            return self.rs[:, cols], self.ln_cs[:, cols], self.betas[:, cols]
+        if isinstance(cols, slice):
+            cols = np.arange(cols.start, cols.stop)
+        if not self.cache_size:
+            return self._derive_params(cols)
+        params = np.empty((3, self.sample_size, len(cols)), dtype=self.dtype)
+        missing = []
+        with self._cache_lock:
+            for j, d in enumerate(cols):
+                cached = self._cache.pop(d, None)
+                if cached is None:
+                    missing.append(j)
+                else:
+                    # Reinsert to mark as the most recently used
+                    self._cache[d] = cached
+                    params[:, :, j] = cached
+        if missing:
+            derived = np.array(self._derive_params(cols[missing]))
+            params[:, :, missing] = derived
+            with self._cache_lock:
+                for j, d in enumerate(cols[missing]):
+                    self._cache[d] = derived[:, :, j].copy()
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return params[0], params[1], params[2]
+
+    def _derive_params(self, cols):
+        '''
+        Derive the random parameters of the dimensions `cols`
+        from the seed and the (sample, dimension) positions.
+        r and c follow Gamma(2, 1), obtained as the sum of two standard
+        exponential variables, and beta follows Uniform(0, 1).
+        '''
+        samples = np.arange(self.sample_size, dtype=np.uint64)
+        counters = (cols.astype(np.uint64)[np.newaxis, :] *
+                np.uint64(self.sample_size) + samples[:, np.newaxis]) * \
+                np.uint64(_num_streams) + self._key
+        us = [_uniform(_splitmix64(counters + np.uint64(i)))
+                for i in range(_num_streams)]
+        rs = -np.log(us[0] * us[1])
+        ln_cs = np.log(-np.log(us[2] * us[3]))
+        betas = us[4]
+        return rs.astype(self.dtype, copy=False), \
+                ln_cs.astype(self.dtype, copy=False), \
+                betas.astype(self.dtype, copy=False)
+
+
+class IncrementalWeightedMinHash(object):
+    '''
+    A Weighted MinHash of a vector whose weights only increase over time,
+    such as counts. It is updated with (dimension, weight increment)
+    pairs, recomputing only the hash values of the samples affected by
+    the updated dimensions instead of the whole vector.
+
+    This relies on a property of Improved Consistent Sampling:
+    the value ln(a) a dimension competes with in each sample can only
+    decrease as its weight increases, so a sample's minimum can only
+    move to an updated dimension, or stay at the same dimension with a
+    new t.
+    '''
+
+    def __init__(self, generator):
+        '''
+        Create an incremental Weighted MinHash of the all-zero vector,
+        using the random parameters of the WeightedMinHashGenerator
+        `generator`.
+        '''
+        self.generator = generator
+        self.weights = dict()
+        self.hashvalues = np.zeros((generator.sample_size, 2), dtype=np.int64)
+        self._min_ln_a = np.full(generator.sample_size, np.inf,
+                dtype=generator.dtype)
+
+    def update(self, dim, weight_delta):
+        '''
+        Increase the weight of the dimension `dim` by `weight_delta`,
+        which must be non-negative.
+        '''
+        self.update_batch([dim], [weight_delta])
+
+    def update_batch(self, dims, weight_deltas):
+        '''
+        Increase the weights of the dimensions `dims` by the non-negative
+        `weight_deltas`, updating the affected samples all at once.
+        Repeated dimensions have their increments summed.
+        '''
+        dims = np.asarray(dims, dtype=np.int64).ravel()
+        weight_deltas = np.asarray(weight_deltas, dtype=np.float64).ravel()
+        if len(dims) != len(weight_deltas):
+            raise ValueError("Dimensions and weight increments must have "
+                    "the same length")
+        if np.any(weight_deltas < 0):
+            raise ValueError("Weights can only increase")
+        if len(dims) == 0:
+            return
+        if dims.min() < 0 or dims.max() >= self.generator.dim:
+            raise ValueError("Input dimension mismatch, expecting "
+                    "dimensions in [0, %d)" % self.generator.dim)
+        dims, inverse = np.unique(dims, return_inverse=True)
+        deltas = np.bincount(inverse, weights=weight_deltas)
+        weights = np.array([self.weights.get(d, 0.0) for d in dims]) + deltas
+        for d, w in zip(dims, weights):
+            if w > 0:
+                self.weights[d] = w
+        nonzero = weights > 0
+        dims, weights = dims[nonzero], weights[nonzero]
+        if len(dims) == 0:
+            return
+        hashvalues, ln_a = self.generator._icws_min(np.log(weights), dims)
+        ks = self.hashvalues[:, 0]
+        # The current minimum of a sample is outdated if its dimension
+        # was updated; its new ln(a) is then among the updated ones and
+        # no larger, so the new minimum is always taken in that case.
+        # Ties are broken by the lowest dimension, as in `minhash`.
+        better = (ln_a < self._min_ln_a) | np.in1d(ks, dims) | \
+                ((ln_a == self._min_ln_a) & (hashvalues[:, 0] < ks))
+        self.hashvalues[better] = hashvalues[better]
+        self._min_ln_a[better] = ln_a[better]
+
+    def minhash(self):
+        '''
+        Returns a WeightedMinHash of the current weights.
+        '''
+        if len(self.weights) == 0:
+            raise ValueError("Cannot create a WeightedMinHash of "
+                    "the all-zero vector")
+        return WeightedMinHash(self.generator.seed, self.hashvalues.copy())
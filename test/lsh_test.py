@@ -2,9 +2,10 @@ import unittest
 from hashlib import sha1
 import pickle
 import numpy as np
-from datasketch.lsh import MinHashLSH, WeightedMinHashLSH
+from datasketch.lsh import MinHashLSH, WeightedMinHashLSH, bBitMinHashLSH
 from datasketch.minhash import MinHash
-from datasketch.weighted_minhash import WeightedMinHashGenerator
+from datasketch.b_bit_minhash import bBitMinHash
+from datasketch.weighted_minhash import WeightedMinHashGenerator, WeightedMinHash
 
 
 class TestMinHashLSH(unittest.TestCase):
@@ -75,6 +76,298 @@ class TestMinHashLSH(unittest.TestCase):
 
         self.assertRaises(ValueError, lsh.remove, "c")
 
+    def test_max_bucket_size(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16, max_bucket_size=2)
+        m1 = MinHash(16)
+        m1.update("a".encode("utf8"))
+        lsh.insert("a", m1)
+        lsh.insert("b", m1)
+        lsh.insert("c", m1)
+        self.assertTrue("c" in lsh)
+        for table, overflow in zip(lsh.hashtables, lsh.overflow):
+            for H in table:
+                self.assertEqual(table[H], ["a", "b"])
+                self.assertEqual(overflow[H], set(["c"]))
+        self.assertEqual(sorted(lsh.query(m1)), ["a", "b"])
+        self.assertEqual(lsh.get_stats()["num_overflowed"], [1] * lsh.b)
+
+        lsh.remove("c")
+        self.assertTrue(all(len(overflow) == 0 for overflow in lsh.overflow))
+        lsh.remove("a")
+        self.assertEqual(lsh.query(m1), ["b"])
+        self.assertRaises(ValueError, MinHashLSH, 0.5, 16,
+                max_bucket_size=0)
+
+    def test_query_budget(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16)
+        m1 = MinHash(16)
+        m1.update("a".encode("utf8"))
+        m2 = MinHash(16)
+        m2.update("a".encode("utf8"))
+        m2.update("b".encode("utf8"))
+        lsh.insert("a", m1)
+        lsh.insert("b", m2)
+        result = lsh.query(m1, budget=1)
+        self.assertEqual(result, ["a"])
+        result = lsh.query(m1, budget=10)
+        self.assertEqual(result[0], "a")
+        self.assertEqual(set(result), set(lsh.query(m1)))
+        self.assertRaises(ValueError, lsh.query, m1, 0)
+
+    def test_query_budget_overlap(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16)
+        m1 = MinHash(16)
+        m1.update("a".encode("utf8"))
+        m2 = MinHash(16)
+        m2.update("b".encode("utf8"))
+        m3 = m1.copy()
+        # m3 collides with m1 in the first band only, so the small
+        # buckets of m1 all hold "a" before "c" is reached
+        start, end = lsh.hashranges[0]
+        m3.hashvalues[end:] = m2.hashvalues[end:]
+        lsh.insert("a", m1)
+        lsh.insert("c", m3)
+        self.assertEqual(set(lsh.query(m1, budget=2)), set(["a", "c"]))
+        self.assertEqual(set(lsh.query(m1, budget=10)), set(["a", "c"]))
+
+    def test_query_budget_votes(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16)
+        m1 = MinHash(16)
+        m1.update("a".encode("utf8"))
+        m2 = MinHash(16)
+        m2.update("b".encode("utf8"))
+        # "a" collides with m1 in the first two bands, the fillers in the
+        # first band only, so "a" is admitted from the small bucket of
+        # the second band before its vote in the first band is scanned
+        m3 = m2.copy()
+        m3.hashvalues[:lsh.hashranges[1][1]] = \
+                m1.hashvalues[:lsh.hashranges[1][1]]
+        lsh.insert("a", m3)
+        for i in range(5):
+            m4 = m2.copy()
+            m4.hashvalues[:lsh.hashranges[0][1]] = \
+                    m1.hashvalues[:lsh.hashranges[0][1]]
+            lsh.insert("f%d" % i, m4)
+        self.assertEqual(lsh.query(m1, min_votes=2), ["a"])
+        self.assertEqual(lsh.query(m1, budget=1, min_votes=2), ["a"])
+        self.assertEqual(lsh.query(m1, budget=3, sort_by_votes=True)[0], "a")
+
+    def test_query_min_votes(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16)
+        m1 = MinHash(16)
+        m1.update("a".encode("utf8"))
+        m2 = MinHash(16)
+        m2.update("b".encode("utf8"))
+        m3 = m1.copy()
+        # Make m3 collide with m1 in exactly one band
+        start, end = lsh.hashranges[0]
+        m3.hashvalues[end:] = m2.hashvalues[end:]
+        lsh.insert("a", m1)
+        lsh.insert("b", m2)
+        lsh.insert("c", m3)
+        self.assertEqual(set(lsh.query(m1)), set(["a", "c"]))
+        self.assertEqual(lsh.query(m1, min_votes=2), ["a"])
+        self.assertEqual(lsh.query(m1, sort_by_votes=True), ["a", "c"])
+        self.assertEqual(lsh.query(m1, min_votes=lsh.b), ["a"])
+        self.assertRaises(ValueError, lsh.query, m1, None, 0)
+        self.assertRaises(ValueError, lsh.query, m1, None, lsh.b + 1)
+
+    def test_params(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16, params=(2, 8))
+        self.assertEqual(lsh.b, 2)
+        self.assertEqual(lsh.r, 8)
+        self.assertEqual(lsh.hashranges, [(0, 8), (8, 16)])
+        self.assertRaises(ValueError, MinHashLSH, 0.5, 16, params=(3, 8))
+
+    def test_query_multi_probe(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16, params=(2, 8))
+        m1 = MinHash(16)
+        m1.update("a".encode("utf8"))
+        m2 = MinHash(16)
+        m2.update("b".encode("utf8"))
+        m3 = m1.copy()
+        # Make m3 differ from m1 in the last two rows of every band
+        for start, end in lsh.hashranges:
+            m3.hashvalues[end-2:end] = m2.hashvalues[end-2:end]
+        lsh.insert("a", m1)
+        lsh.insert("b", m2)
+        self.assertEqual(lsh.query(m3), [])
+        self.assertEqual(lsh.query(m3, probe_depth=1), [])
+        self.assertEqual(lsh.query(m3, probe_depth=2), ["a"])
+        lsh.insert("c", m3)
+        self.assertEqual(lsh.query(m3), ["c"])
+        self.assertEqual(set(lsh.query(m1, probe_depth=2, min_votes=2)),
+                set(["a", "c"]))
+        lsh.remove("c")
+        self.assertEqual(lsh.query(m1, probe_depth=2), ["a"])
+        self.assertRaises(ValueError, lsh.query, m1, probe_depth=8)
+
+    def test_query_multi_probe_updates(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16, params=(2, 8))
+        ms = []
+        for i in range(6):
+            m = MinHash(16)
+            m.update(str(i).encode("utf8"))
+            ms.append(m)
+        lsh.insert(0, ms[0])
+        lsh.query(ms[0], probe_depth=1)
+        # The bucket hashes created and removed after the first
+        # multi-probe query are merged by the next one
+        for i, m in enumerate(ms[1:], 1):
+            lsh.insert(i, m)
+            self.assertTrue(i in lsh.query(m, probe_depth=1))
+        for i in [0, 3, 5]:
+            lsh.remove(i)
+        lsh.insert(5, ms[5])
+        lsh.insert(6, ms[0])
+        lsh.remove(6)
+        for i, hashtable in enumerate(lsh.hashtables):
+            self.assertEqual(lsh._sorted_hashes(i), sorted(hashtable))
+        self.assertEqual(lsh.query(ms[3], probe_depth=1), [])
+        self.assertEqual(lsh.query(ms[5], probe_depth=1), [5])
+        # Many removals at once
+        for i in range(100):
+            m = MinHash(16)
+            m.update(("x%d" % i).encode("utf8"))
+            lsh.insert("x%d" % i, m)
+        lsh.query(ms[1], probe_depth=1)
+        for i in range(80):
+            lsh.remove("x%d" % i)
+        for i, hashtable in enumerate(lsh.hashtables):
+            self.assertEqual(lsh._sorted_hashes(i), sorted(hashtable))
+
+    def test_self_join(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16)
+        minhashes = dict()
+        for key, data in [("a", "x"), ("b", "y"), ("c", "x"), ("d", "x")]:
+            minhashes[key] = MinHash(16)
+            minhashes[key].update(data.encode("utf8"))
+            lsh.insert(key, minhashes[key])
+        pairs = list(lsh.self_join())
+        self.assertEqual(len(pairs), 3)
+        self.assertEqual(set(frozenset(pair) for pair in pairs),
+                set([frozenset(["a", "c"]), frozenset(["a", "d"]),
+                    frozenset(["c", "d"])]))
+
+        # Make d collide with a and c in the first band only,
+        # and with b in all other bands
+        m = minhashes["d"].copy()
+        start, end = lsh.hashranges[0]
+        m.hashvalues[end:] = minhashes["b"].hashvalues[end:]
+        lsh.remove("d")
+        lsh.insert("d", m)
+        minhashes["d"] = m
+        pairs = list(lsh.self_join())
+        self.assertEqual(len(pairs), 4)
+        pairs = dict((frozenset([key1, key2]), jaccard)
+                for key1, key2, jaccard in lsh.self_join(minhashes))
+        self.assertEqual(set(pairs.keys()),
+                set([frozenset(["a", "c"]), frozenset(["b", "d"])]))
+        self.assertEqual(pairs[frozenset(["a", "c"])], 1.0)
+        self.assertEqual(pairs[frozenset(["b", "d"])],
+                minhashes["b"].jaccard(minhashes["d"]))
+        pairs = list(lsh.self_join(minhashes, threshold=0.0))
+        self.assertEqual(len(pairs), 4)
+
+    def test_self_join_max_bucket_size(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16, max_bucket_size=2)
+        minhashes = dict()
+        for key in ["a", "b", "c", "d"]:
+            minhashes[key] = MinHash(16)
+            minhashes[key].update("x".encode("utf8"))
+            lsh.insert(key, minhashes[key])
+        # c and d overflow every bucket, but are still joined
+        pairs = list(lsh.self_join())
+        self.assertEqual(len(pairs), 6)
+        self.assertEqual(set(frozenset(pair) for pair in pairs),
+                set(frozenset([key1, key2]) for key1 in "abcd"
+                    for key2 in "abcd" if key1 < key2))
+        pairs = list(lsh.self_join(minhashes))
+        self.assertEqual(len(pairs), 6)
+        self.assertTrue(all(jaccard == 1.0 for _, _, jaccard in pairs))
+        self.assertEqual(sorted(sorted(c) for c in lsh.self_join_clusters()),
+                [["a", "b", "c", "d"]])
+
+    def test_remove_overflow(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16, max_bucket_size=1)
+        m = MinHash(16)
+        m.update("a".encode("utf8"))
+        for key in ["a", "b", "c"]:
+            lsh.insert(key, m)
+        lsh.remove("a")
+        self.assertEqual(len(lsh.query(m)), 1)
+        self.assertEqual(lsh.get_stats()["num_overflowed"], [1] * lsh.b)
+        pairs = list(lsh.self_join())
+        self.assertEqual(set(frozenset(pair) for pair in pairs),
+                set([frozenset(["b", "c"])]))
+        lsh.remove("b")
+        self.assertEqual(lsh.query(m), ["c"])
+        self.assertTrue(all(len(overflow) == 0 for overflow in lsh.overflow))
+        lsh.remove("c")
+        self.assertTrue(all(len(table) == 0 for table in lsh.hashtables))
+
+    def test_self_join_clusters(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16)
+        for key, data in [("a", "x"), ("b", "y"), ("c", "x"), ("d", "z"),
+                ("e", "y")]:
+            m = MinHash(16)
+            m.update(data.encode("utf8"))
+            lsh.insert(key, m)
+        clusters = lsh.self_join_clusters()
+        self.assertEqual(sorted(sorted(c) for c in clusters),
+                [["a", "c"], ["b", "e"]])
+
+    def test_get_stats(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16)
+        m1 = MinHash(16)
+        m1.update("a".encode("utf8"))
+        m2 = MinHash(16)
+        m2.update("b".encode("utf8"))
+        lsh.insert("a", m1)
+        lsh.insert("b", m2)
+        lsh.insert("c", m1)
+        stats = lsh.get_stats(num_largest=2)
+        self.assertEqual(stats["num_keys"], 3)
+        self.assertEqual(len(stats["num_buckets"]), lsh.b)
+        for hist in stats["bucket_size_histograms"]:
+            self.assertEqual(sum(size * count
+                for size, count in hist.items()), 3)
+        self.assertEqual(len(stats["largest_buckets"]), 2)
+        self.assertEqual(stats["largest_buckets"][0][0], 2)
+        self.assertGreater(stats["memory_estimate"], 0)
+
+    def test_hot_buckets(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16)
+        m1 = MinHash(16)
+        m1.update("a".encode("utf8"))
+        m2 = MinHash(16)
+        m2.update("b".encode("utf8"))
+        lsh.insert("a", m1)
+        lsh.insert("b", m2)
+        lsh.insert("c", m1)
+        hot = lsh.hot_buckets(2)
+        self.assertEqual(len(hot), lsh.b)
+        for i, H, size in hot:
+            self.assertEqual(size, 2)
+            self.assertEqual(set(lsh.hashtables[i][H]), set(["a", "c"]))
+        self.assertEqual(lsh.hot_buckets(3), [])
+
+    def test_query_hook(self):
+        records = []
+        lsh = MinHashLSH(threshold=0.5, num_perm=16,
+                query_hook=records.append)
+        m1 = MinHash(16)
+        m1.update("a".encode("utf8"))
+        lsh.insert("a", m1)
+        lsh.insert("b", m1)
+        lsh.query(m1)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["bands_probed"], lsh.b)
+        self.assertEqual(records[0]["buckets_hit"], lsh.b)
+        self.assertEqual(records[0]["candidates_touched"], 2 * lsh.b)
+        self.assertEqual(records[0]["num_candidates"], 2)
+        self.assertGreaterEqual(records[0]["time"], 0.0)
+
     def test_pickle(self):
         lsh = MinHashLSH(threshold=0.5, num_perm=16)
         m1 = MinHash(16)
@@ -170,5 +463,115 @@ class TestWeightedMinHashLSH(unittest.TestCase):
         result = lsh.query(m2)
         self.assertTrue("b" in result)
 
+    def test_band_keys(self):
+        lsh = WeightedMinHashLSH(threshold=0.5, sample_size=4,
+                params=(2, 2))
+        hashvalues = np.array([[1, 2], [3, -4], [70000, 5], [6, 1 << 40]])
+        m1 = WeightedMinHash(1, hashvalues)
+        m2 = WeightedMinHash(1, hashvalues.copy())
+        # Differ from m1 only beyond the lower 16 bits
+        m2.hashvalues[3][1] += 1 << 20
+        Hs = lsh._band_keys(m1.hashvalues)
+        self.assertEqual(len(Hs), 2)
+        self.assertEqual(Hs[0], lsh._H(hashvalues[0:2]))
+        self.assertEqual(Hs[1], lsh._H(hashvalues[2:4]))
+        lsh.insert("a", m1)
+        self.assertEqual(lsh.query(m1, min_votes=2), ["a"])
+        self.assertEqual(lsh.query(m2, min_votes=2), [])
+        self.assertEqual(lsh.query(m2, probe_depth=1, min_votes=2), ["a"])
+
+    def test_insert_batch(self):
+        lsh = WeightedMinHashLSH(threshold=0.5, sample_size=4)
+        mg = WeightedMinHashGenerator(10, 4)
+        X = np.random.uniform(1, 10, (3, 10))
+        lsh.insert_batch(["a", "b", "c"], mg.minhash_many(X))
+        expected = WeightedMinHashLSH(threshold=0.5, sample_size=4)
+        for key, v in zip(["a", "b", "c"], X):
+            expected.insert(key, mg.minhash(v))
+        self.assertEqual(lsh.keys, expected.keys)
+        self.assertEqual(lsh.hashtables, expected.hashtables)
+
+        lsh.insert_batch(["d"], [mg.minhash(X[0])])
+        self.assertTrue("d" in lsh)
+        self.assertRaises(ValueError, lsh.insert_batch, ["a"],
+                mg.minhash_many(X[:1]))
+        self.assertRaises(ValueError, lsh.insert_batch, ["e", "e"],
+                mg.minhash_many(X[:2]))
+        self.assertRaises(ValueError, lsh.insert_batch, ["e"],
+                mg.minhash_many(X[:2]))
+        self.assertFalse("e" in lsh)
+        mg = WeightedMinHashGenerator(10, 5)
+        self.assertRaises(ValueError, lsh.insert_batch, ["e"],
+                mg.minhash_many(X[:1]))
+
+    def test_query_batch(self):
+        lsh = WeightedMinHashLSH(threshold=0.5, sample_size=4)
+        mg = WeightedMinHashGenerator(10, 4)
+        X = np.random.uniform(1, 10, (3, 10))
+        lsh.insert_batch(["a", "b", "c"], mg.minhash_many(X))
+        results = lsh.query_batch(mg.minhash_many(X))
+        self.assertEqual(len(results), 3)
+        for key, result, v in zip(["a", "b", "c"], results, X):
+            self.assertTrue(key in result)
+            self.assertEqual(set(result), set(lsh.query(mg.minhash(v))))
+        results = lsh.query_batch([mg.minhash(v) for v in X], min_votes=2)
+        self.assertEqual(results,
+                [lsh.query(mg.minhash(v), min_votes=2) for v in X])
+
+
+class TestbBitMinHashLSH(unittest.TestCase):
+
+    def _minhashes(self):
+        m1 = MinHash(16)
+        m1.update("a".encode("utf8"))
+        m2 = MinHash(16)
+        m2.update("b".encode("utf8"))
+        return m1, m2
+
+    def test_init(self):
+        lsh = MinHashLSH(threshold=0.8)
+        for bits in [1, 2, 4]:
+            blsh = bBitMinHashLSH(threshold=0.8, bits=bits)
+            self.assertTrue(blsh.is_empty())
+            # Chance collisions of b-bit values call for longer bands
+            self.assertGreater(blsh.r, lsh.r)
+        self.assertRaises(ValueError, bBitMinHashLSH, bits=0)
+        self.assertRaises(ValueError, bBitMinHashLSH, bits=33)
+        self.assertRaises(ValueError, bBitMinHashLSH, density=1.5)
+
+    def test_insert_query(self):
+        m1, m2 = self._minhashes()
+        lsh = bBitMinHashLSH(threshold=0.5, num_perm=16, bits=2)
+        lsh.insert("a", bBitMinHash(m1, 2))
+        lsh.insert("b", bBitMinHash(m2, 2))
+        for i, H in enumerate(lsh.keys["a"]):
+            self.assertTrue("a" in lsh.hashtables[i][H])
+        self.assertTrue("a" in lsh.query(bBitMinHash(m1, 2)))
+        self.assertTrue("b" in lsh.query(bBitMinHash(m2, 2)))
+        self.assertRaises(ValueError, lsh.insert, "c", bBitMinHash(m1, 1))
+        self.assertRaises(ValueError, lsh.query, bBitMinHash(m1, 1))
+        m3 = MinHash(18)
+        self.assertRaises(ValueError, lsh.insert, "c", bBitMinHash(m3, 2))
+        lsh.remove("a")
+        self.assertTrue("a" not in lsh.keys)
+
+    def test_multi_probe(self):
+        m1, m2 = self._minhashes()
+        lsh = bBitMinHashLSH(threshold=0.5, num_perm=16, bits=2,
+                params=(2, 8))
+        lsh.insert("a", bBitMinHash(m1, 2))
+        self.assertTrue("a" in lsh.query(bBitMinHash(m1, 2), probe_depth=3))
+
+    def test_self_join(self):
+        m1, m2 = self._minhashes()
+        bms = {"a": bBitMinHash(m1, 8), "b": bBitMinHash(m1, 8),
+                "c": bBitMinHash(m2, 8)}
+        lsh = bBitMinHashLSH(threshold=0.5, num_perm=16, bits=8)
+        for key in sorted(bms):
+            lsh.insert(key, bms[key])
+        pairs = list(lsh.self_join(bms))
+        self.assertEqual([p[:2] for p in pairs], [("a", "b")])
+        self.assertEqual(pairs[0][2], 1.0)
+
 if __name__ == "__main__":
     unittest.main()
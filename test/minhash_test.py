@@ -3,7 +3,7 @@ import struct
 import pickle
 import numpy as np
 from datasketch import minhash
-from datasketch.b_bit_minhash import bBitMinHash
+from datasketch.b_bit_minhash import bBitMinHash, bBitMinHashStore
 
 class FakeHash(object):
     '''
@@ -196,6 +196,28 @@ class TestbBitMinHash(unittest.TestCase):
         bm1 = bBitMinHash(m1)
         self.assertTrue(bm1.jaccard(bm2) < 1.0)
 
+    def test_packed(self):
+        for b in [1, 2, 3, 8, 32]:
+            bm = bBitMinHash(self.m, b)
+            self.assertEqual(bm._planes.shape, (b, 2))
+            self.assertTrue(np.array_equal(bm.hashvalues,
+                    self.m.hashvalues & ((1 << b) - 1)))
+            self.assertEqual(len(bm), len(self.m))
+
+    def test_jaccard_count(self):
+        m1 = minhash.MinHash(100, 1, hashobj=FakeHash)
+        m2 = minhash.MinHash(100, 1, hashobj=FakeHash)
+        m1.update(11)
+        m2.update(12)
+        for b in [1, 2, 5, 32]:
+            bm1 = bBitMinHash(m1, b)
+            bm2 = bBitMinHash(m2, b)
+            expected = np.count_nonzero(bm1.hashvalues == bm2.hashvalues)
+            self.assertEqual(bm1._count_equal(bm2), expected)
+        m3 = minhash.MinHash(64, 1, hashobj=FakeHash)
+        self.assertRaises(ValueError, bBitMinHash(m1).jaccard,
+                bBitMinHash(m3))
+
     def test_bytesize(self):
         s = bBitMinHash(self.m).bytesize()
         self.assertGreaterEqual(s, 8*2+4+1+self.m.hashvalues.size/64)
@@ -214,6 +236,110 @@ class TestbBitMinHash(unittest.TestCase):
                 bm2 = pickle.loads(pickle.dumps(bm))
                 self.assertEqual(bm, bm2)
 
+    def test_serialize(self):
+        for b in [1, 3, 6, 8, 27]:
+            bm = bBitMinHash(self.m, b, r=0.1)
+            for tight in [False, True]:
+                buf = bytearray(bm.bytesize(tight))
+                bm.serialize(buf, tight)
+                self.assertEqual(bBitMinHash.deserialize(buf), bm)
+            self.assertRaises(ValueError, bm.serialize, bytearray(10))
+        # Exactly b bits per hash value
+        bm = bBitMinHash(self.m, 3)
+        self.assertEqual(bm.bytesize(tight=True),
+                struct.calcsize('<qBdi') + (128 * 3) // 8)
+
+    def test_pickle_partial_block(self):
+        m = minhash.MinHash(num_perm=37, hashobj=FakeHash)
+        m.update(11)
+        m.update(123)
+        for b in [1, 2, 4, 8, 16, 32]:
+            bm = bBitMinHash(m, b)
+            bm2 = pickle.loads(pickle.dumps(bm))
+            self.assertEqual(bm, bm2)
+            self.assertEqual(len(bm2.hashvalues), 37)
+
+    def test_zero_bits(self):
+        bm = bBitMinHash(self.m, 0)
+        self.assertEqual(len(bm), len(self.m))
+        self.assertTrue(np.array_equal(bm.hashvalues,
+                np.zeros(len(self.m), dtype=np.uint32)))
+        self.assertEqual(pickle.loads(pickle.dumps(bm)), bm)
+        for tight in [False, True]:
+            buf = bytearray(bm.bytesize(tight))
+            bm.serialize(buf, tight)
+            self.assertEqual(bBitMinHash.deserialize(buf), bm)
+
+    def test_block_layout(self):
+        # The first hash value of a block is stored in its highest slot.
+        blocks = bBitMinHash._pack_blocks(np.array([1, 2, 3], dtype=np.uint32),
+                16, 4, 1)
+        self.assertEqual(int(blocks[0]), (1 << 48) | (2 << 32) | (3 << 16))
+        hvs = bBitMinHash._unpack_blocks(blocks, 16, 4, 3)
+        self.assertTrue(np.array_equal(hvs, [1, 2, 3]))
+
+
+
+class TestbBitMinHashStore(unittest.TestCase):
+
+    def _minhashes(self, n, num_perm=128):
+        ms = []
+        for i in range(n):
+            m = minhash.MinHash(num_perm, 1, hashobj=FakeHash)
+            for d in range(i, i + 20):
+                m.update(d)
+            ms.append(m)
+        return ms
+
+    def test_scan(self):
+        ms = self._minhashes(50)
+        for b in [1, 2, 8]:
+            bms = [bBitMinHash(m, b, r=[0.0, 0.1, 0.3][i % 3])
+                    for i, m in enumerate(ms)]
+            store = bBitMinHashStore(128, b, 1, block_size=16)
+            store.add_many(bms)
+            self.assertEqual(len(store), 50)
+            q = bBitMinHash(ms[10], b, r=0.2)
+            expected = np.array([q.jaccard(bm) for bm in bms])
+            indices, estimates = store.scan(q)
+            self.assertTrue(np.array_equal(indices, np.arange(50)))
+            self.assertTrue(np.allclose(estimates, expected))
+            indices, estimates = store.scan(q, threshold=0.5)
+            self.assertTrue(np.array_equal(indices,
+                    np.nonzero(expected >= 0.5)[0]))
+            self.assertTrue(np.allclose(estimates, expected[indices]))
+
+    def test_corrections(self):
+        rs = [0.0, 1e-6, 0.1, 0.5, 0.9, 1.0]
+        for b in [1, 2, 8]:
+            for r in [0.0, 0.3]:
+                bm = bBitMinHash(self._minhashes(1)[0], b, r)
+                a1 = bBitMinHash._calc_a(r, b)
+                expected = np.array([bBitMinHash._calc_c(a1,
+                        bBitMinHash._calc_a(r2, b), r, r2) for r2 in rs])
+                c1, c2 = bm._corrections(rs)
+                self.assertTrue(np.allclose(c1, expected[:, 0]))
+                self.assertTrue(np.allclose(c2, expected[:, 1]))
+
+    def test_add_after_scan(self):
+        ms = self._minhashes(3)
+        store = bBitMinHashStore(128, 1, 1)
+        indices, estimates = store.scan(bBitMinHash(ms[0]))
+        self.assertEqual(len(indices), 0)
+        store.add(bBitMinHash(ms[0]))
+        store.scan(bBitMinHash(ms[0]))
+        store.add_many([bBitMinHash(ms[1]), bBitMinHash(ms[2])])
+        indices, estimates = store.scan(bBitMinHash(ms[2]), threshold=1.0)
+        self.assertEqual(list(indices), [2])
+
+    def test_check(self):
+        m = self._minhashes(1)[0]
+        store = bBitMinHashStore(128, 1, 1)
+        self.assertRaises(ValueError, store.add, bBitMinHash(m, 2))
+        self.assertRaises(ValueError, store.scan, bBitMinHash(m, 2))
+        m2 = self._minhashes(1, num_perm=64)[0]
+        self.assertRaises(ValueError, store.add, bBitMinHash(m2, 1))
+
 
 if __name__ == "__main__":
     unittest.main()
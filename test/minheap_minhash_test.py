@@ -37,6 +37,19 @@ class TestMinhashOPHR(unittest.TestCase):
         m = MinHashMinHeap(4)
         self.assertTrue(m.is_empty())
 
+    def test_len(self):
+        m = MinHashMinHeap(16)
+        for v in [b'a', b'b', b'c']:
+            m.update(v)
+        self.assertEqual(len(m), 16)
+        # Only the values seen are kept, without padding
+        self.assertEqual(len(m.hashvalues), 3)
+        self.assertFalse(m.is_empty())
+        m2 = MinHashMinHeap.deserialize(m.__getstate__())
+        self.assertFalse(m2.is_empty())
+        self.assertTrue(MinHashMinHeap.deserialize(
+                MinHashMinHeap(4).__getstate__()).is_empty())
+
     def test_update(self):
         m1 = MinHashMinHeap(4, hashobj=FakeHash)
         m2 = MinHashMinHeap(4, hashobj=FakeHash)
@@ -91,13 +104,33 @@ class TestMinhashOPHR(unittest.TestCase):
         hashes = [(hashlib.sha1, 'sha1'), (hashlib.sha256, 'sha256'), (hashlib.sha512, 'sha512'), (hashlib.md5, 'md5')]
         for hashobj, hashstr in hashes:
             m1 = MinHashMinHeap(4, hashobj=hashobj, hashstr=hashstr)
-            m1.update('10')
+            m1.update(b'10')
             buf = bytearray(m1.bytesize())
             m1.serialize(buf)
             m1_deserialized = MinHashMinHeap.deserialize(buf)
             self.assertEqual(m1.hashobj, m1_deserialized.hashobj)
             self.assertEqual(m1, m1_deserialized)
 
+    def test_serialization_lazy(self):
+        m1 = MinHashMinHeap(8)
+        for i in range(20):
+            m1.update(str(i).encode('utf8'))
+        self.assertEqual(m1.bytesize(), 10 + 8 * 4)
+        buf = bytearray(m1.bytesize())
+        m1.serialize(buf)
+        m2 = MinHashMinHeap.deserialize(bytes(buf))
+        # The heap is rebuilt on first use
+        self.assertTrue(m2._heap is None)
+        self.assertEqual(m1, m2)
+        self.assertEqual(m1.jaccard(m2), 1.0)
+        m1.update(b'x')
+        m2.update(b'x')
+        self.assertEqual(m1.hashvalues, m2.hashvalues)
+        buf[0] = 0
+        self.assertRaises(ValueError, MinHashMinHeap.deserialize, buf)
+        m3 = MinHashMinHeap(4)
+        self.assertEqual(pickle.loads(pickle.dumps(m3)), m3)
+
 
 if __name__ == "__main__":
     unittest.main()
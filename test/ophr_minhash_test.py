@@ -45,6 +45,60 @@ class TestMinhashOPHR(unittest.TestCase):
         m1.update(12)
         self.assertTrue(np.any(m1._hashvalues != m2._hashvalues))
 
+    def test_update_batch(self):
+        m1 = MinHashOPHR(16)
+        m2 = MinHashOPHR(16)
+        values = [str(i).encode('utf8') for i in range(100)]
+        for v in values:
+            m1.update(v)
+        m2.update_batch(values)
+        self.assertEqual(m1, m2)
+        self.assertTrue(np.array_equal(m1.hashvalues, m2.hashvalues))
+        m2.update_batch([])
+        self.assertEqual(m1, m2)
+        m1.hashvalues
+        m1.update_batch([b'a', b'b'])
+        m2.update(b'a')
+        m2.update(b'b')
+        self.assertTrue(np.array_equal(m1.hashvalues, m2.hashvalues))
+
+    def test_merge(self):
+        m1 = MinHashOPHR(16)
+        m2 = MinHashOPHR(16)
+        m = MinHashOPHR(16)
+        values = [str(i).encode('utf8') for i in range(100)]
+        m1.update_batch(values[:60])
+        m2.update_batch(values[40:])
+        m.update_batch(values)
+        m1.hashvalues
+        m1.merge(m2)
+        self.assertEqual(m1, m)
+        self.assertTrue(np.array_equal(m1.hashvalues, m.hashvalues))
+        self.assertRaises(ValueError, m1.merge, MinHashOPHR(8))
+        self.assertRaises(ValueError, m1.merge,
+                MinHashOPHR(16, hashobj=FakeHash))
+
+    def test_union(self):
+        ms = [MinHashOPHR(16) for _ in range(3)]
+        m = MinHashOPHR(16)
+        values = [str(i).encode('utf8') for i in range(90)]
+        for i, mi in enumerate(ms):
+            mi.update_batch(values[i*30:(i+1)*30])
+        m.update_batch(values)
+        u = MinHashOPHR.union(*ms)
+        self.assertEqual(u, m)
+        self.assertEqual(u.k_val, 16)
+        self.assertRaises(ValueError, MinHashOPHR.union, m)
+        self.assertRaises(ValueError, MinHashOPHR.union, m, MinHashOPHR(8))
+
+    def test_count(self):
+        m = MinHashOPHR(256)
+        self.assertEqual(m.count(), 0.0)
+        m.update_batch([str(i).encode('utf8') for i in range(100)])
+        self.assertAlmostEqual(m.count(), 100, delta=20)
+        m.update_batch([str(i).encode('utf8') for i in range(10000)])
+        self.assertAlmostEqual(m.count(), 10000, delta=2000)
+
     def test_dense_hashvalues(self):
         m1 = MinHashOPHR(4, hashobj=FakeHash)
         m2 = MinHashOPHR(4, hashobj=FakeHash)
@@ -56,6 +110,37 @@ class TestMinhashOPHR(unittest.TestCase):
         m2.update(12)
         self.assertTrue(np.all(m1.hashvalues == m2.hashvalues))
 
+    def test_densify(self):
+        m = MinHashOPHR(8, hashobj=FakeHash)
+        m.update(10)
+        m.update(13)
+        hvs = m.hashvalues
+        self.assertEqual(hvs[2], 10)
+        self.assertEqual(hvs[5], 13)
+        # Empty bins borrow from the next non-empty bin, wrapping around
+        for i, j in [(0, 2), (1, 2), (3, 5), (4, 5), (6, 10), (7, 10)]:
+            expected = int((m._hashvalues[j % 8] + m.rot_constant * (j - i))
+                    % (2 ** 32 - 2))
+            self.assertEqual(hvs[i], expected)
+
+    def test_densify_optimal(self):
+        self.assertRaises(ValueError, MinHashOPHR, 8, densification='foo')
+        m1 = MinHashOPHR(64, hashobj=FakeHash, densification='optimal')
+        m2 = MinHashOPHR(64, hashobj=FakeHash, densification='optimal')
+        self.assertTrue(np.all(m1.hashvalues == 2 ** 32 - 1))
+        m1.update(10)
+        self.assertTrue(np.all(m1.hashvalues == 10))
+        for v in [10, 13, 100, 1000]:
+            m1.update(v)
+            m2.update(v)
+        hvs = m1.hashvalues
+        # Empty bins copy the value of a non-empty bin
+        self.assertEqual(set(hvs), set(m1._hashvalues[m1._hashvalues != 2 ** 32 - 1]))
+        self.assertTrue(np.array_equal(hvs, m2.hashvalues))
+        self.assertEqual(m1.jaccard(m2), 1.0)
+        m3 = MinHashOPHR(64, hashobj=FakeHash)
+        self.assertRaises(ValueError, m1.jaccard, m3)
+
     def test_jaccard(self):
         m1 = MinHashOPHR(4, hashobj=FakeHash)
         m2 = MinHashOPHR(4, hashobj=FakeHash)
@@ -103,13 +188,27 @@ class TestMinhashOPHR(unittest.TestCase):
         hashes = [(hashlib.sha1, 'sha1'), (hashlib.sha256, 'sha256'), (hashlib.sha512, 'sha512'), (hashlib.md5, 'md5')]
         for hashobj, hashstr in hashes:
             m1 = MinHashOPHR(4, hashobj=hashobj, hashstr=hashstr)
-            m1.update('10')
+            m1.update(b'10')
             buf = bytearray(m1.bytesize())
             m1.serialize(buf)
             m1_deserialized = MinHashOPHR.deserialize(buf)
             self.assertEqual(m1.hashobj, m1_deserialized.hashobj)
             self.assertEqual(m1, m1_deserialized)
 
+    def test_serialization_densification(self):
+        m1 = MinHashOPHR(16, densification='optimal')
+        m1.update_batch([b'a', b'b', b'c'])
+        m2 = pickle.loads(pickle.dumps(m1))
+        self.assertEqual(m2.densification, 'optimal')
+        self.assertTrue(np.array_equal(m1.hashvalues, m2.hashvalues))
+        self.assertEqual(m1.bytesize(), 7 + 16 * 4)
+        buf = bytearray(m1.bytesize())
+        m1.serialize(buf)
+        buf[0] = 0
+        self.assertRaises(ValueError, MinHashOPHR.deserialize, buf)
+        m3 = MinHashOPHR(16, hashobj=FakeHash, hashstr='fake')
+        self.assertRaises(ValueError, m3.serialize, buf)
+
 
 if __name__ == "__main__":
     unittest.main()
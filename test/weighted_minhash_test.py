@@ -1,7 +1,10 @@
 import unittest
 import pickle
 import numpy as np
-from datasketch.weighted_minhash import WeightedMinHashGenerator, WeightedMinHash
+from datasketch import weighted_minhash
+from datasketch.weighted_minhash import WeightedMinHashGenerator, WeightedMinHash, \
+        IncrementalWeightedMinHash
+from datasketch.b_bit_minhash import bBitWeightedMinHash, bBitMinHashStore
 
 class TestWeightedMinHash(unittest.TestCase):
 
@@ -12,6 +15,64 @@ class TestWeightedMinHash(unittest.TestCase):
         self.assertEqual(p.seed, m.seed)
         self.assertTrue(np.array_equal(p.hashvalues, m.hashvalues))
 
+    def test_copy(self):
+        mg = WeightedMinHashGenerator(4, 10, 1)
+        m = mg.minhash([1,2,3,4])
+        c = m.copy()
+        self.assertEqual(c, m)
+        c.hashvalues[0][0] += 1
+        self.assertNotEqual(c, m)
+
+    def test_bytesize(self):
+        mg = WeightedMinHashGenerator(4, 10, 1)
+        m = mg.minhash([1,2,3,4])
+        # Both k and t fit in a single byte
+        self.assertEqual(m.bytesize(), 1 + 8 + 4 + 1 + 1 + 10 * 2)
+        m.hashvalues[0] = [70000, -40000]
+        self.assertEqual(m.bytesize(), 1 + 8 + 4 + 1 + 1 + 10 * 8)
+
+    def test_serialize(self):
+        mg = WeightedMinHashGenerator(300, 10, 1)
+        m = mg.minhash(np.random.uniform(1, 1000, 300))
+        m.hashvalues[1] = [299, -129]
+        buf = bytearray(m.bytesize())
+        m.serialize(buf)
+        md = WeightedMinHash.deserialize(buf)
+        self.assertEqual(md, m)
+        self.assertTrue(md.hashvalues.dtype == np.int64)
+        md = WeightedMinHash.deserialize(bytes(buf))
+        self.assertEqual(md, m)
+        self.assertRaises(ValueError, m.serialize, bytearray(10))
+        buf[0] = 0
+        self.assertRaises(ValueError, WeightedMinHash.deserialize, buf)
+
+    def test_jaccard(self):
+        mg = WeightedMinHashGenerator(20, 64, 1)
+        m1 = mg.minhash(np.random.uniform(1, 10, 20))
+        m2 = mg.minhash(np.random.uniform(1, 10, 20))
+        expected = sum(np.array_equal(this, that) for this, that in
+                zip(m1.hashvalues, m2.hashvalues)) / 64.0
+        self.assertEqual(m1.jaccard(m2), expected)
+        self.assertEqual(m1.jaccard(m1), 1.0)
+        mg = WeightedMinHashGenerator(20, 64, 2)
+        m3 = mg.minhash(np.random.uniform(1, 10, 20))
+        self.assertRaises(ValueError, m1.jaccard, m3)
+
+    def test_jaccard_many(self):
+        mg = WeightedMinHashGenerator(20, 64, 1)
+        X = np.random.uniform(1, 10, (5, 20))
+        ms = [mg.minhash(v) for v in X]
+        expected = [ms[0].jaccard(m) for m in ms]
+        self.assertTrue(np.array_equal(ms[0].jaccard_many(ms), expected))
+        self.assertTrue(np.array_equal(
+            ms[0].jaccard_many(mg.minhash_many(X)), expected))
+        self.assertEqual(len(ms[0].jaccard_many([])), 0)
+        self.assertEqual(len(ms[0].jaccard_many(mg.minhash_many(X[:0]))), 0)
+        mg = WeightedMinHashGenerator(20, 32, 2)
+        self.assertRaises(ValueError, ms[0].jaccard_many,
+                [mg.minhash(X[0])])
+        self.assertRaises(ValueError, ms[0].jaccard_many, mg.minhash_many(X))
+
 class TestWeightedMinHashGenerator(unittest.TestCase):
 
     def test_init(self):
@@ -28,7 +89,266 @@ class TestWeightedMinHashGenerator(unittest.TestCase):
         self.assertIsInstance(m, WeightedMinHash)
         self.assertEqual(len(m.hashvalues), 4)
         self.assertEqual(len(m), 4)
-        self.assertTrue(m.hashvalues.dtype == np.int)
+        self.assertTrue(m.hashvalues.dtype == np.int64)
+
+    def test_minhash_all_zero(self):
+        mg = WeightedMinHashGenerator(4, 4, 1)
+        self.assertRaises(ValueError, mg.minhash, [0, 0, 0, 0])
+        X = np.random.uniform(1, 10, (3, 4))
+        X[1] = 0.0
+        self.assertRaises(ValueError, mg.minhash_many, X)
+
+    def test_minhash_vectorized(self):
+        mg = WeightedMinHashGenerator(50, 16, 1)
+        v = np.random.uniform(1, 100, 50)
+        # Compute the hash values one sample at a time for reference
+        expected = np.zeros((16, 2), dtype=np.int64)
+        for i in range(16):
+            t = np.floor((np.log(v) / mg.rs[i]) + mg.betas[i])
+            ln_y = (t - mg.betas[i]) * mg.rs[i]
+            ln_a = mg.ln_cs[i] - ln_y - mg.rs[i]
+            k = np.argmin(ln_a)
+            expected[i][0], expected[i][1] = k, int(t[k])
+        self.assertTrue(np.array_equal(mg.minhash(v).hashvalues, expected))
+        # Force processing the dimensions in chunks
+        max_chunk_size = weighted_minhash._max_chunk_size
+        try:
+            weighted_minhash._max_chunk_size = 16 * 7
+            self.assertTrue(np.array_equal(mg.minhash(v).hashvalues,
+                expected))
+        finally:
+            weighted_minhash._max_chunk_size = max_chunk_size
+
+    def test_minhash_sparse(self):
+        mg = WeightedMinHashGenerator(20, 8, 1)
+        v = np.zeros(20)
+        v[[2, 5, 11, 17]] = [3.0, 0.5, 7.0, 1.5]
+        expected = mg.minhash(v)
+        m = mg.minhash_sparse([17, 2, 11, 5], [1.5, 3.0, 7.0, 0.5])
+        self.assertEqual(m, expected)
+        m = mg.minhash({2: 3.0, 5: 0.5, 11: 7.0, 17: 1.5, 3: 0.0})
+        self.assertEqual(m, expected)
+        self.assertRaises(ValueError, mg.minhash_sparse, [1, 2], [1.0])
+        self.assertRaises(ValueError, mg.minhash_sparse, [1, 20], [1.0, 1.0])
+        self.assertRaises(ValueError, mg.minhash_sparse, [1, 1], [1.0, 1.0])
+        self.assertRaises(ValueError, mg.minhash_sparse, [1], [-1.0])
+        self.assertRaises(ValueError, mg.minhash_sparse, [1], [0.0])
+
+    def test_minhash_scipy_sparse(self):
+        try:
+            from scipy.sparse import csr_matrix
+        except ImportError:
+            raise unittest.SkipTest("scipy is not installed")
+        mg = WeightedMinHashGenerator(20, 8, 1)
+        v = np.zeros(20)
+        v[[2, 5, 11, 17]] = [3.0, 0.5, 7.0, 1.5]
+        self.assertEqual(mg.minhash(csr_matrix(v)), mg.minhash(v))
+        self.assertRaises(ValueError, mg.minhash, csr_matrix(np.ones(10)))
+
+    def test_minhash_many(self):
+        mg = WeightedMinHashGenerator(20, 8, 1)
+        X = np.random.uniform(1, 10, (7, 20))
+        X[X < 4] = 0.0
+        expected = np.array([mg.minhash(v).hashvalues for v in X])
+        hashvalues = mg.minhash_many(X)
+        self.assertEqual(hashvalues.shape, (7, 8, 2))
+        self.assertTrue(np.array_equal(hashvalues, expected))
+        hashvalues = mg.minhash_many(X, num_threads=3, chunk_size=2)
+        self.assertTrue(np.array_equal(hashvalues, expected))
+        self.assertRaises(ValueError, mg.minhash_many, X[:, :10])
+        self.assertRaises(ValueError, mg.minhash_many, X, chunk_size=0)
+
+    def test_minhash_many_sparse(self):
+        try:
+            from scipy.sparse import csr_matrix
+        except ImportError:
+            raise unittest.SkipTest("scipy is not installed")
+        mg = WeightedMinHashGenerator(20, 8, 1)
+        X = np.random.uniform(1, 10, (7, 20))
+        X[X < 4] = 0.0
+        expected = np.array([mg.minhash(v).hashvalues for v in X])
+        hashvalues = mg.minhash_many(csr_matrix(X), num_threads=2,
+                chunk_size=3)
+        self.assertTrue(np.array_equal(hashvalues, expected))
+
+    def test_lazy_pickle(self):
+        mg = WeightedMinHashGenerator(10000000, 8, 1, lazy=True,
+                cache_size=4)
+        m1 = mg.minhash({3: 1.0, 9999999: 2.0})
+        mg2 = pickle.loads(pickle.dumps(mg))
+        self.assertEqual(len(mg2._cache), 0)
+        m2 = mg2.minhash({3: 1.0, 9999999: 2.0})
+        self.assertTrue(np.array_equal(m1.hashvalues, m2.hashvalues))
+        mg = WeightedMinHashGenerator(10, 8, 1)
+        mg2 = pickle.loads(pickle.dumps(mg))
+        self.assertTrue(np.array_equal(mg.rs, mg2.rs))
+
+    def test_lazy(self):
+        mg = WeightedMinHashGenerator(10000000, 8, 1, lazy=True)
+        self.assertFalse(hasattr(mg, "rs"))
+        rs, ln_cs, betas = mg._params(np.array([3, 9999999]))
+        self.assertEqual(rs.shape, (8, 2))
+        self.assertTrue(np.all(rs > 0))
+        self.assertTrue(np.all((betas > 0) & (betas < 1)))
+        m1 = mg.minhash({3: 1.0, 9999999: 2.0})
+        m2 = WeightedMinHashGenerator(10000000, 8, 1, lazy=True).minhash(
+                {3: 1.0, 9999999: 2.0})
+        m3 = WeightedMinHashGenerator(10000000, 8, 2, lazy=True).minhash(
+                {3: 1.0, 9999999: 2.0})
+        self.assertTrue(np.array_equal(m1.hashvalues, m2.hashvalues))
+        self.assertFalse(np.array_equal(m1.hashvalues, m3.hashvalues))
+
+    def test_lazy_dense(self):
+        mg = WeightedMinHashGenerator(20, 8, 1, lazy=True)
+        v = np.zeros(20)
+        v[[2, 5, 11, 17]] = [3.0, 0.5, 7.0, 1.5]
+        self.assertEqual(mg.minhash(v),
+                mg.minhash_sparse([2, 5, 11, 17], [3.0, 0.5, 7.0, 1.5]))
+
+    def test_lazy_cache(self):
+        mg = WeightedMinHashGenerator(1000, 8, 1, lazy=True)
+        mg_cached = WeightedMinHashGenerator(1000, 8, 1, lazy=True,
+                cache_size=3)
+        for indices in [[1, 2, 3], [2, 3, 4, 5], [1, 5, 999]]:
+            weights = np.random.uniform(1, 10, len(indices))
+            self.assertEqual(mg.minhash_sparse(indices, weights),
+                    mg_cached.minhash_sparse(indices, weights))
+            self.assertLessEqual(len(mg_cached._cache), 3)
+        self.assertEqual(set(mg_cached._cache.keys()), set([1, 5, 999]))
+
+    def test_float32(self):
+        mg64 = WeightedMinHashGenerator(50, 32, 1)
+        mg32 = WeightedMinHashGenerator(50, 32, 1, dtype=np.float32)
+        self.assertEqual(mg32.rs.dtype, np.float32)
+        self.assertEqual(mg32.ln_cs.dtype, np.float32)
+        self.assertEqual(mg32.betas.dtype, np.float32)
+        v1 = np.random.uniform(1, 10, 50)
+        v2 = np.random.uniform(1, 10, 50)
+        m1, m2 = mg32.minhash(v1), mg32.minhash(v2)
+        self.assertTrue(m1.hashvalues.dtype == np.int64)
+        self.assertAlmostEqual(m1.jaccard(m2),
+                mg64.minhash(v1).jaccard(mg64.minhash(v2)), delta=0.2)
+        mg32 = WeightedMinHashGenerator(50, 32, 1, lazy=True,
+                dtype=np.float32)
+        self.assertEqual(mg32._params(np.arange(3))[0].dtype, np.float32)
+        mg32.minhash(v1)
+        self.assertRaises(ValueError, WeightedMinHashGenerator, 50,
+                dtype=np.int32)
+
+class TestIncrementalWeightedMinHash(unittest.TestCase):
+
+    def _check_updates(self, mg):
+        im = IncrementalWeightedMinHash(mg)
+        self.assertRaises(ValueError, im.minhash)
+        v = np.zeros(mg.dim)
+        for _ in range(30):
+            dim = np.random.randint(0, mg.dim)
+            delta = np.random.uniform(0, 5)
+            im.update(dim, delta)
+            v[dim] += delta
+            self.assertEqual(im.minhash(), mg.minhash(v))
+        dims = np.random.randint(0, mg.dim, 15)
+        deltas = np.random.uniform(0, 5, 15)
+        im.update_batch(dims, deltas)
+        np.add.at(v, dims, deltas)
+        self.assertEqual(im.minhash(), mg.minhash(v))
+
+    def test_update(self):
+        self._check_updates(WeightedMinHashGenerator(20, 32, 1))
+
+    def test_update_lazy(self):
+        self._check_updates(WeightedMinHashGenerator(20, 32, 1, lazy=True))
+
+    def test_update_errors(self):
+        mg = WeightedMinHashGenerator(20, 32, 1)
+        im = IncrementalWeightedMinHash(mg)
+        self.assertRaises(ValueError, im.update, 1, -1.0)
+        self.assertRaises(ValueError, im.update, 20, 1.0)
+        self.assertRaises(ValueError, im.update_batch, [1, 2], [1.0])
+        im.update(3, 0.0)
+        self.assertEqual(len(im.weights), 0)
+
+class TestbBitWeightedMinHash(unittest.TestCase):
+
+    def setUp(self):
+        self.mg = WeightedMinHashGenerator(100, 256, 1)
+        self.v1 = np.random.uniform(1, 10, 100)
+        self.v2 = self.v1.copy()
+        self.v2[:30] = np.random.uniform(1, 10, 30)
+        self.m1 = self.mg.minhash(self.v1)
+        self.m2 = self.mg.minhash(self.v2)
+
+    def test_init(self):
+        for b in [0, 1, 2, 3, 8, 32]:
+            bm = bBitWeightedMinHash(self.m1, b)
+            self.assertEqual(len(bm), 256)
+            self.assertEqual(bm.b, b)
+            if b > 0:
+                self.assertTrue(np.all(bm.hashvalues < (1 << b)))
+        bm = bBitWeightedMinHash(self.m1, 0)
+        self.assertTrue(np.array_equal(bm.hashvalues, self.m1.hashvalues[:, 0]))
+        self.assertRaises(ValueError, bBitWeightedMinHash, self.m1, 33)
+
+    def test_jaccard(self):
+        j = self.m1.jaccard(self.m2)
+        for b in [0, 1, 2, 4, 8]:
+            bm1 = bBitWeightedMinHash(self.m1, b)
+            bm2 = bBitWeightedMinHash(self.m2, b)
+            self.assertEqual(bm1.jaccard(bm1), 1.0)
+            self.assertAlmostEqual(bm1.jaccard(bm2), j, delta=0.2)
+        self.assertRaises(ValueError, bBitWeightedMinHash(self.m1, 0).jaccard,
+                bBitWeightedMinHash(self.m2, 1))
+
+    def test_store(self):
+        for b in [0, 2]:
+            store = bBitMinHashStore(256, b, 1)
+            store.add(bBitWeightedMinHash(self.m1, b))
+            store.add(bBitWeightedMinHash(self.m2, b))
+            q = bBitWeightedMinHash(self.m2, b)
+            indices, estimates = store.scan(q)
+            self.assertEqual(list(indices), [0, 1])
+            self.assertAlmostEqual(estimates[0],
+                    q.jaccard(bBitWeightedMinHash(self.m1, b)))
+            self.assertEqual(estimates[1], 1.0)
+
+    def test_pickle(self):
+        for b in [0, 1, 3, 8]:
+            bm = bBitWeightedMinHash(self.m1, b)
+            p = pickle.loads(pickle.dumps(bm))
+            self.assertEqual(p, bm)
+            buf = bytearray(bm.bytesize(tight=True))
+            bm.serialize(buf, tight=True)
+            self.assertEqual(bBitWeightedMinHash.deserialize(buf), bm)
+
+    def test_lsh(self):
+        from datasketch.lsh import WeightedMinHashLSH, bBitMinHashLSH
+        lsh = WeightedMinHashLSH(threshold=0.5, sample_size=256)
+        bm1 = bBitWeightedMinHash(self.m1, 0)
+        lsh.insert(0, bm1)
+        self.assertTrue(0 in lsh.query(bm1))
+        for b in [1, 8]:
+            bm1 = bBitWeightedMinHash(self.m1, b)
+            self.assertRaises(ValueError, lsh.insert, b, bm1)
+            self.assertRaises(ValueError, lsh.query, bm1)
+            blsh = bBitMinHashLSH(threshold=0.5, num_perm=256, bits=b)
+            blsh.insert(b, bm1)
+            self.assertTrue(b in blsh.query(bm1))
+
+    def test_lsh_chance_collisions(self):
+        from datasketch.lsh import bBitMinHashLSH
+        # Unrelated 1-bit sketches agree on about half of their values,
+        # which the b-bit index must not take as a high similarity
+        mg = WeightedMinHashGenerator(100, 256, 1)
+        lsh = bBitMinHashLSH(threshold=0.5, num_perm=256, bits=1)
+        for i in range(50):
+            v = np.zeros(100)
+            v[i*2:i*2+2] = 1.0
+            lsh.insert(i, bBitWeightedMinHash(mg.minhash(v), 1))
+        v = np.zeros(100)
+        v[:2] = 1.0
+        result = lsh.query(bBitWeightedMinHash(mg.minhash(v), 1))
+        self.assertTrue(0 in result)
+        self.assertLess(len(result), 10)
 
 if __name__ == "__main__":
     unittest.main()